@@ -0,0 +1,107 @@
+import hashlib
+import json
+import pathlib
+import shutil
+import tempfile
+from typing import List, Optional, Dict
+
+MANIFEST_NAME = "manifest.json"
+
+
+def hash_file(path: pathlib.Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_values(*values: str) -> str:
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(value.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CacheEntry:
+    # a single cached routine result, stored as a directory named by the cache key
+    # artifacts are written to a temporary directory first and only moved into place once the routine
+    #   succeeds, so a partial entry is never used
+    def __init__(self, directory: pathlib.Path, key: str):
+        self.key = key
+        self.path = directory / key
+        self._pending: Optional[pathlib.Path] = None
+
+    @property
+    def exists(self) -> bool:
+        return (self.path / MANIFEST_NAME).exists()
+
+    @property
+    def artifacts(self) -> List[str]:
+        return json.loads((self.path / MANIFEST_NAME).read_text()).get("artifacts", [])
+
+    def open(self, name: str):
+        return (self.path / name).open("rb")
+
+    def add(self, name: str, source: pathlib.Path):
+        """copy an artifact file into the entry; name can contain subdirectories"""
+        if self._pending is None:
+            self._pending = pathlib.Path(tempfile.mkdtemp(dir=self.path.parent, prefix=".pending-"))
+        destination = self._pending / name
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, destination)
+
+    def commit(self, artifacts: List[str]):
+        pending = self._pending
+        if pending is None:
+            pending = pathlib.Path(tempfile.mkdtemp(dir=self.path.parent, prefix=".pending-"))
+        (pending / MANIFEST_NAME).write_text(json.dumps({"artifacts": artifacts}))
+        self._pending = None
+        try:
+            pending.rename(self.path)
+        except OSError:
+            # another run already stored the same key
+            shutil.rmtree(pending, ignore_errors=True)
+
+    def discard(self):
+        if self._pending is not None:
+            shutil.rmtree(self._pending, ignore_errors=True)
+            self._pending = None
+
+
+class BuildCache:
+    # This class stores the artifacts of successful routines keyed by the routine's inputs so that an
+    #   unchanged routine can be restored instead of running its container again
+    # The key for a routine is built from:
+    #   - the image ID
+    #   - the resolved CLI, with references to input files replaced by the hash of their contents (token
+    #     files get random names each run); an input directory is hashed from the names and contents of its files
+    #   - the artifact list
+    #   - the keys of its dependencies (their artifacts are not hashed directly since they might not be
+    #     present yet or be stale)
+    def __init__(self, directory: pathlib.Path):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._file_hashes: Dict[pathlib.Path, str] = {}
+
+    def _hash_file(self, path: pathlib.Path) -> str:
+        if path not in self._file_hashes:
+            self._file_hashes[path] = hash_file(path)
+        return self._file_hashes[path]
+
+    def _hash_path(self, path: pathlib.Path) -> str:
+        if path.is_file():
+            return self._hash_file(path)
+        files = sorted([f for f in path.rglob("*") if f.is_file()])
+        return hash_values(*[value for f in files for value in [f.relative_to(path).as_posix(), self._hash_file(f)]])
+
+    def key(
+        self, image_id: str, cli: str, artifacts: List[str], inputs: List[pathlib.Path], dependency_keys: List[str]
+    ) -> str:
+        for input_path in inputs:
+            cli = cli.replace(input_path.name, self._hash_path(input_path))
+        return hash_values(image_id, cli, *artifacts, "|", *sorted(dependency_keys))
+
+    def entry(self, key: str) -> CacheEntry:
+        return CacheEntry(directory=self.directory, key=key)
@@ -1,13 +1,15 @@
 import os
 import click
+from typing import TYPE_CHECKING
 
-from .config import Config
-from .routines import Routine
-from .jobs import JobHandler
-
-from .log import logger
+from .log import logger, print_and_log
 from .settings import global_settings
 
+# commands import what they need (config, runner, daemon server) themselves since those pull in the Docker,
+#   AWS, SMB and C2 client libraries, which would slow down commands that do not use them (e.g. run --daemon)
+if TYPE_CHECKING:
+    from .config import Config
+
 
 def log_settings():
     # log the global settings to the log after resolving environment vars
@@ -23,6 +25,11 @@ def validate_path_exists(path) -> bool:
 def handle_config_input(ctx, param, value):
     # callback handler for auto-converting a path input value to a Config object
     validate_path_exists(value)
+    # runs submitted to the daemon are loaded by the daemon
+    if ctx.params.get("daemon", False):
+        return value
+    from .config import Config
+
     cfg = Config.from_file(value)
     log_settings()
     return cfg
@@ -43,25 +50,99 @@ def main():
 
 @click.command("run")
 @SharedOptions.config
-def subcmd_run(config: Config, **kwargs):
-    # init'ing the routines will cause the token resolution (therefore downloading shellcode) so its done first
-    routines = [Routine(**payload.__dict__, config=config) for payload in config.payloads]
+@click.option(
+    "--fail-fast/--keep-going",
+    "fail_fast",
+    default=False,
+    help="stop starting new jobs after the first failure (default: keep running jobs unrelated to the failure)",
+)
+@click.option(
+    "--stop-running",
+    "stop_running",
+    is_flag=True,
+    default=False,
+    help="with --fail-fast, also stop containers that are still running after the first failure",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=None,
+    help="restore jobs with unchanged inputs from the build cache instead of running them (default: PDCD_BUILD_CACHE)",
+)
+@click.option(
+    "--resume",
+    "resume",
+    is_flag=True,
+    default=False,
+    help="resume an interrupted run in the same file_dir, skipping jobs that already completed",
+)
+@click.option(
+    "-q",
+    "--quiet",
+    "quiet",
+    is_flag=True,
+    default=False,
+    help="do not print container output while jobs run (it is still written to PDCD_OUTPUT_DIR)",
+)
+@click.option(
+    "--daemon",
+    "daemon",
+    is_flag=True,
+    default=False,
+    is_eager=True,
+    help="submit the run to a running pdcd daemon (see pdcd serve) instead of running it in this process",
+)
+def subcmd_run(
+    config: "Config",
+    fail_fast: bool,
+    stop_running: bool,
+    resume: bool,
+    quiet: bool,
+    daemon: bool,
+    use_cache: bool = None,
+    **kwargs,
+):
+    options = {
+        "fail_fast": fail_fast,
+        "stop_running": stop_running,
+        "resume": resume,
+        "use_cache": use_cache,
+        "console_output": not quiet,
+    }
+    if daemon:
+        from .daemon import submit_run
+
+        # config is a path here; the daemon loads it
+        #   streamed output is printed by the daemon
+        result = submit_run(config_path=config, options=options)
+        summary, failed = result["summary"], result["failed"]
+    else:
+        from .runner import run_config
 
-    # after generation, push local files to share
-    if config.remote_build:
-        config.file_manager.sync_local_to_remote()
+        jobhandler = run_config(config=config, **options)
+        summary, failed = jobhandler.summary(), jobhandler.failed
 
-    # run all jobs
-    jobhandler = JobHandler(routines=routines, workers=config.workers)
-    jobhandler.run()
+    print_and_log("Run summary:")
+    for line in summary:
+        print_and_log(f"\t{line}")
+    if failed:
+        raise SystemExit(1)
 
-    # pull down all remote files after completion
-    if config.remote_build:
-        config.file_manager.sync_remote_to_local()
 
-    # cleanup activities
-    jobhandler.cleanup_routines()
-    config.cleanup_resources()
+@click.command("serve")
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=str,
+    help="path to the daemon socket (default: PDCD_DAEMON_SOCKET)",
+    required=False,
+)
+def subcmd_serve(socket_path: str = None):
+    from .daemon import serve
+
+    log_settings()
+    serve(socket_path=socket_path)
 
 
 @click.command("logs")
@@ -70,7 +151,7 @@ def subcmd_run(config: Config, **kwargs):
     "-l", "--limit", "limit", type=int, help="max number of containers to retrieve from", required=False, default=3
 )
 @click.option("-i", "--image", "image", type=str, help="limit logs to just this image", required=False)
-def subcmd_logs(config: Config, limit: int, image: str = None):
+def subcmd_logs(config: "Config", limit: int, image: str = None):
     docker = config.client_manager.get_client_by_name("docker").client
 
     if image:
@@ -96,6 +177,7 @@ def subcmd_logs(config: Config, limit: int, image: str = None):
 
 main.add_command(subcmd_run)
 main.add_command(subcmd_logs)
+main.add_command(subcmd_serve)
 
 
 if __name__ == "__main__":
@@ -5,11 +5,16 @@ import pathlib
 import tempfile
 import os
 import shutil
-from typing import List, Optional, TYPE_CHECKING, Any
+from typing import List, Optional, TYPE_CHECKING, Any, Dict
 from docker.client import DockerClient as DockerSDKClient
 
 from .external import DockerClient, FileRegistryClient, ArtifactClient
-from .files import set_fm_for_config
+from .files import set_fm_for_config, close_smb_sessions
+from .endpoints import DockerPool
+from .output import OutputStreamer
+from .pulls import ImagePuller
+from .volumes import SHARED_VOLUME_TYPES
+from . import connectors
 from .connectors import convert_connector_dict_to_clients, RemoteBuildClient, ClientManager
 from .log import logger
 from .settings import global_settings
@@ -26,6 +31,21 @@ class PayloadConfig:
     artifacts: List[str] = field(default_factory=list)
     dependencies: List[str] = field(default_factory=list)
     store: str = None
+    priority: int = 0
+    cache: bool = True
+    warm: bool = False
+    timeout: Optional[int] = None
+    # container limits; default to the docker_mem_limit setting and no CPU/process limits
+    mem_limit: Optional[str] = None
+    cpus: Optional[float] = None
+    cpuset: Optional[str] = None
+    pids_limit: Optional[int] = None
+    # key: list of values; one routine is run per combination of values
+    matrix: Optional[Dict[str, List[Any]]] = None
+
+    @property
+    def routine_args(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if k != "matrix"}
 
 
 class UserSharedConfigs:
@@ -54,6 +74,8 @@ class Config:
     cleanup: bool = True
     workers: int = 2
     settings: Any = None
+    # "volume" or "tmpfs" to use a Docker volume as the shared directory instead of bind mounting file_dir
+    shared_volume: Optional[str] = None
 
     @classmethod
     def from_file(cls, path: str) -> "Config":
@@ -75,10 +97,16 @@ class Config:
         self.remote_build = False
         self.mnt_dir = self.file_dir
         self.file_manager = None
+        # set by the runner when container output is streamed
+        self.output: Optional[OutputStreamer] = None
+        # set by the runner when missing images are pulled
+        self.pulls: Optional[ImagePuller] = None
         docker_client_args = {}
 
         if not os.access(self.file_dir, os.W_OK):
             raise Exception(f"File directory {self.file_dir} not writable")
+        if self.shared_volume is not None and self.shared_volume not in SHARED_VOLUME_TYPES:
+            raise Exception(f"shared_volume must be one of {', '.join(SHARED_VOLUME_TYPES)}")
 
         self.client_manager = ClientManager()
 
@@ -122,6 +150,7 @@ class Config:
         # this should occur after checking for the remote connector to ensure that
         # the Docker env is set
         self.init_default_clients(docker_args=docker_client_args)
+        self.docker_pool = DockerPool.from_config(self)
 
         set_fm_for_config(self)
         if self.remote_build:
@@ -134,18 +163,34 @@ class Config:
         # - files for storing artifacts for other jobs
         # - artifacts for noting CLI paths should be added to artifact list
         docker_args = docker_args if docker_args is not None else {}
-        self.client_manager.upsert_client(client_name="docker", client=DockerClient(**docker_args))
+        if connectors.client_cache is not None:
+            docker_host = docker_args.get("environment", os.environ).get("DOCKER_HOST", "")
+            docker_client = connectors.client_cache.get_or_create(
+                key=f"docker:{docker_host}", factory=lambda: DockerClient(**docker_args)
+            )
+        else:
+            docker_client = DockerClient(**docker_args)
+        self.client_manager.upsert_client(client_name="docker", client=docker_client)
         self.client_manager.upsert_client(client_name="files", client=FileRegistryClient())
         self.client_manager.upsert_client(client_name="artifact", client=ArtifactClient())
 
-    def cleanup_resources(self):
+    def cleanup_resources(self, stop_clients: bool = True):
         # delete remote directory and stop port forwards
-        # TODO: should run on all exits, incl. failed runs
+        # port forwards are left running when the clients are reused by later runs (see pdcd serve)
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+        if self.pulls is not None:
+            self.pulls.close()
+            self.pulls = None
+        self.docker_pool.close()
         if self.remote_build:
-            for (func, kwargs) in [
-                (self.file_manager.rmdir, {"directory": self.remote_client.fwd_params.smb_uuid}),
-                (self.remote_client.stop_forwarding, {}),
-            ]:
+            operations = [(self.file_manager.rmdir, {"directory": self.remote_client.fwd_params.smb_uuid})]
+            if stop_clients:
+                # pooled SMB sessions use the port forward
+                operations.append((close_smb_sessions, {"port": self.remote_client.fwd_params.smb_bind_port}))
+                operations.append((self.remote_client.stop_forwarding, {}))
+            for (func, kwargs) in operations:
                 try:
                     func(**kwargs)
                 except:
@@ -1,10 +1,12 @@
+import json
 import shutil
+import threading
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from typing import TypeVar, List
+from typing import TypeVar, List, Callable, Optional
 
 from .utils import CaseInsensitiveEnum
-from .external import CobaltStrikeClient, MythicClient, RemoteBuildClient
+from .external import CobaltStrikeClient, MythicClient, RemoteBuildClient, DockerClient
 
 
 @dataclass
@@ -85,10 +87,36 @@ class RemoteBuildConnector(Connector):
         return super().to_client()
 
 
+@dataclass
+class DockerConnector(Connector):
+    class Meta:
+        # additional Docker daemons that jobs can be placed on alongside the default Docker client
+        client_cls = DockerClient
+        unique = False
+
+    base_url: str  # e.g. tcp://10.0.0.5:2375 or unix:///var/run/docker.sock
+    # path on the Docker host with the same contents as the file directory (e.g. an NFS mount)
+    # when empty, input files are copied into each container before it starts
+    mnt_dir: str = ""
+    workers: int = 0  # max jobs on this daemon; defaults to the config workers
+    mem_budget: str = ""  # defaults to the memory reported by the daemon
+    cpu_budget: float = 0  # defaults to the CPUs reported by the daemon
+
+    def to_client(self):
+        return DockerClient(
+            base_url=self.base_url,
+            mnt_dir=self.mnt_dir or None,
+            workers=self.workers or None,
+            mem_budget=self.mem_budget or None,
+            cpu_budget=self.cpu_budget or None,
+        )
+
+
 class Connectors(CaseInsensitiveEnum):
     CobaltStrike = CobaltStrikeConnector
     Mythic = MythicConnector
     Remote = RemoteBuildConnector
+    Docker = DockerConnector
 
 
 @dataclass
@@ -131,6 +159,43 @@ class ClientManager:
             self.upsert_client(client_name=cw.name, client=cw.client)
 
 
+class ClientCache:
+    # This class allows clients to be reused across configs in a long-running process (see pdcd serve)
+    # Clients are keyed by their connector type and arguments, so a config with the same connector settings
+    #   gets the already logged-in/forwarding client along with any results it has cached (e.g. shellcode)
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def all_clients(self) -> list:
+        with self._lock:
+            return list(self._clients.values())
+
+    def get_or_create(self, key: str, factory: Callable):
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            return self._clients[key]
+
+
+# only set when running as a daemon; otherwise every config creates its own clients
+client_cache: Optional[ClientCache] = None
+
+
+def enable_client_cache() -> ClientCache:
+    global client_cache
+    client_cache = ClientCache()
+    return client_cache
+
+
+def connector_to_client(connector: Connector):
+    if client_cache is None:
+        return connector.to_client()
+    key = f"{type(connector).__name__}:{json.dumps(connector.__dict__, sort_keys=True)}"
+    return client_cache.get_or_create(key=key, factory=connector.to_client)
+
+
 def convert_connector_dict_to_clients(connector_dict: dict) -> ClientManager:
     # this method is responsible for converting a dict of connector config info
     # into a client manager instance. the connector info should be sourced from either
@@ -164,5 +229,5 @@ def convert_connector_dict_to_clients(connector_dict: dict) -> ClientManager:
         except Exception as e:
             raise e  # TODO
         else:
-            clients[name] = connector.to_client()
+            clients[name] = connector_to_client(connector)
     return ClientManager(clients=clients)
@@ -0,0 +1,167 @@
+import http.client
+import http.server
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import threading
+
+from .log import logger, print_and_log
+from .settings import global_settings
+
+# the server's dependencies (config, runner and with them the Docker/SMB/C2 clients) are imported when the
+#   server is created so that submitting a run with pdcd run --daemon stays fast
+
+# options accepted from clients for a run; they map directly to run_config() kwargs
+RUN_OPTIONS = ["fail_fast", "stop_running", "resume", "use_cache", "console_output"]
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Requests:
+    #   GET /health -> {"status": "ok"}
+    #   POST /runs {"config": <path>, "cwd": <client cwd>, "options": {...}} -> {"summary": [...], "failed": bool}
+    # A run request blocks until the run is finished
+    server: "PdcdDaemon"
+
+    def address_string(self) -> str:
+        # unix sockets do not have a client address
+        return "local"
+
+    def log_message(self, format, *args):
+        logger.info(f"Daemon request: {format % args}")
+
+    def _send_json(self, status: int, body: dict):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/runs":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            config_path = request["config"]
+            cwd = request.get("cwd", os.getcwd())
+            options = {k: v for k, v in request.get("options", {}).items() if k in RUN_OPTIONS}
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Invalid run request: {e}"})
+            return
+
+        try:
+            self._send_json(200, self.server.run(config_path=config_path, cwd=cwd, options=options))
+        except Exception as e:
+            logger.exception(f"Run for {config_path} failed")
+            self._send_json(500, {"error": str(e)})
+
+
+class PdcdDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # This class is a long-running pdcd process that accepts runs over a local Unix socket
+    # Clients (connectors) are kept between runs so a run does not pay for logging in to C2 servers,
+    #   exporting the same shellcode again, starting SSM port forwards, or creating Docker clients
+    # Runs are executed one at a time since config-level settings modify the (process-wide) global settings
+    daemon_threads = True
+
+    def __init__(self, socket_path: pathlib.Path):
+        from . import connectors
+
+        self.socket_path = pathlib.Path(socket_path)
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        self._run_lock = threading.Lock()
+        self.client_cache = connectors.enable_client_cache()
+        # only the current user can submit runs; the umask applies when the socket file is created by bind()
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.socket_path.as_posix(), DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def run(self, config_path: str, cwd: str, options: dict) -> dict:
+        from .config import Config
+        from .runner import run_config
+
+        with self._run_lock:
+            settings = global_settings.__dict__.copy()
+            daemon_cwd = os.getcwd()
+            try:
+                # relative paths in the config (e.g. file_dir) are relative to where the client was run
+                os.chdir(cwd)
+                logger.info(f"Starting run for {config_path}")
+                config = Config.from_file(config_path)
+                logger.info(f"Using global settings: {global_settings.json()}")
+                jobhandler = run_config(config=config, stop_clients=False, **options)
+            finally:
+                # restore any settings changed by the config
+                global_settings.__dict__.update(settings)
+                os.chdir(daemon_cwd)
+        return {"summary": jobhandler.summary(), "failed": jobhandler.failed}
+
+    def server_close(self):
+        from .external import RemoteBuildClient
+        from .files import close_smb_sessions
+
+        super().server_close()
+        close_smb_sessions()
+        for client in self.client_cache.all_clients:
+            if isinstance(client, RemoteBuildClient) and client.forwarding:
+                client.stop_forwarding()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: pathlib.Path, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = pathlib.Path(socket_path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path.as_posix())
+
+
+def serve(socket_path: pathlib.Path = None):
+    socket_path = socket_path if socket_path is not None else global_settings.daemon_socket
+    daemon = PdcdDaemon(socket_path=socket_path)
+    print_and_log(f"Listening on {pathlib.Path(socket_path).as_posix()}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+def submit_run(config_path: str, options: dict, socket_path: pathlib.Path = None) -> dict:
+    """submit a run to a running daemon and wait for the result"""
+    socket_path = socket_path if socket_path is not None else global_settings.daemon_socket
+    socket_path = pathlib.Path(socket_path)
+    if not socket_path.exists():
+        raise Exception(f"No pdcd daemon listening on {socket_path.as_posix()} (start one with pdcd serve)")
+
+    conn = UnixHTTPConnection(socket_path=socket_path)
+    try:
+        body = json.dumps({"config": os.path.abspath(config_path), "cwd": os.getcwd(), "options": options})
+        conn.request("POST", "/runs", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        result = json.loads(response.read())
+    finally:
+        conn.close()
+
+    if response.status != 200:
+        raise Exception(f"Daemon run failed: {result.get('error')}")
+    return result
@@ -0,0 +1,168 @@
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional, TYPE_CHECKING
+from docker.client import DockerClient as DockerSDKClient
+
+from .external import DockerClient
+from .events import ContainerWatcher
+from .images import ImageIndex, ImageInfo
+from .warm import WarmPool
+from .volumes import SharedVolume
+from .resources import ResourceBudget, Resources, parse_memory
+from .settings import global_settings
+from .log import logger
+
+if TYPE_CHECKING:
+    from .config import Config
+    from .routines import Routine
+
+
+@dataclass
+class DockerEndpoint:
+    # a single Docker daemon that routines can be placed on
+    # mnt_dir is the path on the Docker host that is mounted into containers as the shared directory
+    #   when it is not set, the host has no access to the shared files so a routine's input files are
+    #   copied into the container before it starts
+    # when a shared volume is set, it is mounted as the shared directory instead of mnt_dir and input files
+    #   are copied into it
+    name: str
+    client: DockerClient
+    budget: ResourceBudget
+    workers: int
+    mnt_dir: Optional[str] = None
+    volume: Optional[SharedVolume] = None
+    running: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        # the event stream is only opened once the first container is registered
+        self.watcher = ContainerWatcher(docker=self.docker)
+        self.images = ImageIndex(docker=self.docker)
+        self.warm = WarmPool(size=global_settings.warm_pool_size, max_uses=global_settings.warm_container_uses)
+
+    @property
+    def docker(self) -> DockerSDKClient:
+        return self.client.docker
+
+    @property
+    def stages_inputs(self) -> bool:
+        return self.mnt_dir is None or self.volume is not None
+
+    def has_image(self, image: str) -> bool:
+        return self.images.get(image) is not None
+
+    def image(self, image: str) -> ImageInfo:
+        if (info := self.images.get(image)) is None:
+            raise Exception(f'Unknown image "{image}" on Docker endpoint {self.name}')
+        return info
+
+    def image_id(self, image: str) -> str:
+        return self.image(image).id
+
+    def free_ratio(self) -> float:
+        """fraction of the endpoint's memory budget that is not reserved"""
+        available = self.budget.available
+        return available.memory / self.budget.capacity.memory if self.budget.capacity.memory > 0 else 0
+
+
+class DockerPool:
+    # This class holds all Docker endpoints for a run and places routines on them
+    # A routine can only be placed on an endpoint that has its image. Among those, the endpoint with the
+    #   most free capacity is picked
+    def __init__(self, endpoints: List[DockerEndpoint]):
+        self.endpoints = endpoints
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: "Config") -> "DockerPool":
+        # the default Docker client always uses the config's mount directory (local file dir or remote share)
+        #   and the global scheduler settings
+        default = config.client_manager.get_client_by_name("docker")
+        endpoints = [
+            DockerEndpoint(
+                name=default.name,
+                client=default.client,
+                budget=ResourceBudget.from_docker(
+                    docker=default.client.docker,
+                    memory=parse_memory(global_settings.scheduler_mem_budget),
+                    cpus=global_settings.scheduler_cpu_budget,
+                ),
+                workers=config.workers,
+                mnt_dir=config.mnt_dir,
+                volume=SharedVolume(
+                    docker=default.client.docker,
+                    tmpfs=config.shared_volume == "tmpfs",
+                    size=global_settings.shared_tmpfs_size,
+                    keeper_image=global_settings.shared_volume_image,
+                )
+                if config.shared_volume is not None
+                else None,
+            )
+        ]
+
+        for cw in config.client_manager.get_clients_by_type(client_type=DockerClient):
+            if cw.name == default.name:
+                continue
+            client: DockerClient = cw.client
+            endpoints.append(
+                DockerEndpoint(
+                    name=cw.name,
+                    client=client,
+                    budget=ResourceBudget.from_docker(
+                        docker=client.docker, memory=parse_memory(client.mem_budget), cpus=client.cpu_budget
+                    ),
+                    workers=client.workers if client.workers else config.workers,
+                    mnt_dir=client.mnt_dir if client.mnt_dir else None,
+                )
+            )
+            logger.info(f"Added Docker endpoint {cw.name}")
+
+        return cls(endpoints=endpoints)
+
+    @property
+    def default(self) -> DockerEndpoint:
+        return self.endpoints[0]
+
+    @property
+    def stages_inputs(self) -> bool:
+        """whether any endpoint needs input files copied from the controller"""
+        return any([endpoint.stages_inputs for endpoint in self.endpoints])
+
+    def has_image(self, image: str) -> bool:
+        return any([endpoint.has_image(image) for endpoint in self.endpoints])
+
+    def image_id(self, image: str) -> str:
+        """ID of an image on the first endpoint that has it"""
+        for endpoint in self.endpoints:
+            if endpoint.has_image(image):
+                return endpoint.image_id(image)
+        raise Exception(f'Unknown image "{image}"')
+
+    def place(self, routine: "Routine", request: Resources) -> Optional[DockerEndpoint]:
+        """pick an endpoint for a routine and reserve the requested resources on it"""
+        with self._lock:
+            candidates = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint.has_image(routine.image)
+                and endpoint.running < endpoint.workers
+                and endpoint.budget.can_admit(request)
+            ]
+            if len(candidates) == 0:
+                return None
+
+            endpoint = max(candidates, key=lambda e: e.free_ratio())
+            endpoint.budget.reserve(request)
+            endpoint.running += 1
+            return endpoint
+
+    def release(self, endpoint: DockerEndpoint, request: Resources):
+        with self._lock:
+            endpoint.budget.release(request)
+            endpoint.running -= 1
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.warm.close()
+            endpoint.watcher.close()
+            if endpoint.volume is not None:
+                endpoint.volume.remove()
@@ -0,0 +1,125 @@
+import concurrent.futures
+import threading
+import time
+from typing import Dict, Optional
+from docker.client import DockerClient as DockerSDKClient
+
+from .log import logger
+
+# seconds to wait before reconnecting a dropped event stream
+RECONNECT_DELAY = 1
+
+
+class ContainerWatcher:
+    # This class learns about container exits from a single Docker event stream rather than having
+    #   a blocked thread (and HTTP connection) per container in a wait() call
+    # Only "die" events for containers with the pdcd label are requested from the daemon. A container
+    #   must be registered via expect() before it is started so that an exit cannot be missed
+    # Commands run in an existing container with exec are watched the same way using "exec_die" events
+    # If the stream drops (e.g. the port forward to a remote daemon is interrupted), it is reopened
+    #   from the time of the last seen event and pending containers are checked directly
+    def __init__(self, docker: DockerSDKClient):
+        self._docker = docker
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, concurrent.futures.Future] = {}
+        self._execs = set()
+        self._stream = None
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+        self._since: Optional[int] = None
+
+    def _open_stream(self):
+        self._stream = self._docker.events(
+            since=self._since,
+            decode=True,
+            filters={"type": "container", "event": ["die", "exec_die"], "label": "pdcd=true"},
+        )
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._since = int(time.time())
+            self._open_stream()
+            self._thread = threading.Thread(target=self._watch, name="pdcd-events", daemon=True)
+            self._thread.start()
+
+    def expect(self, ctr_id: str, is_exec: bool = False) -> concurrent.futures.Future:
+        """register a container (or exec) before it is started; the returned future resolves to its exit code"""
+        self.start()
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._waiters[ctr_id] = future
+            if is_exec:
+                self._execs.add(ctr_id)
+        return future
+
+    def forget(self, ctr_id: str):
+        with self._lock:
+            self._waiters.pop(ctr_id, None)
+            self._execs.discard(ctr_id)
+
+    def _resolve(self, ctr_id: str, exit_code: int):
+        with self._lock:
+            future = self._waiters.pop(ctr_id, None)
+            self._execs.discard(ctr_id)
+        if future is not None:
+            future.set_result(exit_code)
+
+    def _reconcile(self):
+        # exits that happened while the stream was down are picked up by inspecting the containers directly
+        with self._lock:
+            pending = [(ctr_id, ctr_id in self._execs) for ctr_id in self._waiters.keys()]
+        for ctr_id, is_exec in pending:
+            try:
+                if is_exec:
+                    state = self._docker.api.exec_inspect(ctr_id)
+                    exited = not state.get("Running")
+                else:
+                    state = self._docker.api.inspect_container(ctr_id)["State"]
+                    exited = state.get("Status") in ["exited", "dead"]
+            except Exception as e:
+                logger.error(f"Could not inspect {'exec' if is_exec else 'container'} {ctr_id[:12]}: {e}")
+                continue
+            if exited:
+                self._resolve(ctr_id, state.get("ExitCode"))
+
+    def _watch(self):
+        while not self._closing:
+            try:
+                for event in self._stream:
+                    self._since = event.get("time", self._since)
+                    actor = event.get("Actor", {})
+                    attributes = actor.get("Attributes", {})
+                    exit_code = attributes.get("exitCode")
+                    exit_code = int(exit_code) if exit_code is not None else None
+                    if event.get("Action", "").startswith("exec_die"):
+                        if (exec_id := attributes.get("execID")) is not None:
+                            self._resolve(exec_id, exit_code)
+                        else:
+                            # older daemons do not include the exec ID
+                            self._reconcile()
+                    else:
+                        self._resolve(actor.get("ID", event.get("id")), exit_code)
+            except Exception as e:
+                if self._closing:
+                    break
+                logger.error(f"Docker event stream failed: {e}")
+
+            if self._closing:
+                break
+            logger.warning(f"Reconnecting Docker event stream for {self._docker.api.base_url}")
+            time.sleep(RECONNECT_DELAY)
+            try:
+                self._open_stream()
+                self._reconcile()
+            except Exception as e:
+                logger.error(f"Could not reconnect Docker event stream: {e}")
+
+    def close(self):
+        self._closing = True
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except Exception:
+                pass
@@ -8,17 +8,25 @@ import boto3
 import subprocess
 import json
 import os
+import threading
 from dataclasses import dataclass, field
 from typing import Optional, TYPE_CHECKING, Tuple
 import mythic.mythic as mythic_sdk
 import asyncio
 from abc import ABC, abstractmethod
 import base64
-from functools import lru_cache
 
 from .shellcode import Shellcode
 from .log import logger
-from .utils import shell, find_free_local_port, generate_uuid, pad_list, file_is_empty
+from .utils import (
+    shell,
+    find_free_local_port,
+    generate_uuid,
+    pad_list,
+    file_is_empty,
+    wait_for_local_port,
+    single_flight,
+)
 from .settings import global_settings
 
 if TYPE_CHECKING:
@@ -45,6 +53,11 @@ class ClientABC(ABC):
         # args/kwargs are for client specific logic
         pass
 
+    def prefetch_token(self, token: str):
+        # optional: do the expensive part of resolving a token (e.g. exporting shellcode) ahead of time
+        # this is called concurrently for all unique tokens in a config before the payloads are resolved
+        pass
+
 
 class CobaltStrikeClient(ClientABC):
     # This client generates temporary Cortana scripts to execute functions against a teamserver
@@ -62,8 +75,11 @@ class CobaltStrikeClient(ClientABC):
         self.__user = f"pdcd_{epoch}_{rand_str}"
 
         self.__install_dir = install_dir
+        # every connection uses the same user, which the teamserver only allows to be connected once
+        self.__connection_lock = threading.Lock()
 
-    def resolve_token(self, token: str, file_dir: str, connector_name: str, **kwargs):
+    @staticmethod
+    def _parse_token(token: str) -> Tuple[dict, Optional[str]]:
         # token format: < STAGED / STAGELESS > [PS] - < 64 / 86 > - < LISTENER > -[B64]
         # examples:
         #   x64 stageless shellcode using HTTPS listener: STAGELESS-64-HTTPS
@@ -80,7 +96,16 @@ class CobaltStrikeClient(ClientABC):
             artifact = artifact[:-2]
         artifact = artifact.lower() == "stageless"
 
-        sc = self.export_shellcode(arch=f"x{arch}", listener=listener, stageless=artifact, scformat=scformat)
+        return dict(arch=f"x{arch}", listener=listener, stageless=artifact, scformat=scformat), postproc
+
+    def prefetch_token(self, token: str):
+        export_args, _ = self._parse_token(token)
+        self.export_shellcode(**export_args)
+
+    def resolve_token(self, token: str, file_dir: str, connector_name: str, **kwargs):
+        export_args, postproc = self._parse_token(token)
+        scformat = export_args["scformat"]
+        sc = self.export_shellcode(**export_args)
 
         if postproc == "B64":
             sc = Shellcode(shellcode=base64.b64encode(sc.shellcode))
@@ -114,11 +139,14 @@ class CobaltStrikeClient(ClientABC):
 
         logger.info(f"Validatd credentials for {type(self).__name__} against {self.__user}@{self.__host}:{self.__port}")
 
-    @lru_cache(maxsize=None)
+    @single_flight
     def export_shellcode(self, arch: str, listener: str, stageless: bool = True, scformat: str = "raw") -> Shellcode:
         # this function is cached to improve performance when repeatedly using the same CLI token
         # this client announces in the teamserver event log when it connects/disconnects
+        with self.__connection_lock:
+            return self._export_shellcode(arch=arch, listener=listener, stageless=stageless, scformat=scformat)
 
+    def _export_shellcode(self, arch: str, listener: str, stageless: bool, scformat: str) -> Shellcode:
         self.validate_credentials()
 
         tmp_cna = tempfile.mkstemp(suffix=".cna")[1]
@@ -176,7 +204,8 @@ class MythicClient(ClientABC):
             raise ValueError(f"Mythic httpx_config path must be absolute, got: {httpx_config}")
         self.__httpx_config = httpx_config
 
-    def resolve_token(self, token: str, file_dir: str, connector_name: str, **kwargs) -> Tuple[str, list]:
+    @staticmethod
+    def _parse_token(token: str) -> dict:
         # token format: < ARTIFACT > - < PROFILE >
         # example:
         #   Exe using HTTPS callback: EXE-HTTP
@@ -186,9 +215,16 @@ class MythicClient(ClientABC):
         scformat = "Shellcode"
         if artifact == "EXE":
             scformat = "WinExe"
-        extension = ".bin" if scformat == "Shellcode" else ".exe"
+        return dict(profile=profile, scformat=scformat)
+
+    def prefetch_token(self, token: str):
+        self.export_shellcode(**self._parse_token(token))
 
-        sc = self.export_shellcode(profile=profile, scformat=scformat)
+    def resolve_token(self, token: str, file_dir: str, connector_name: str, **kwargs) -> Tuple[str, list]:
+        export_args = self._parse_token(token)
+        extension = ".bin" if export_args["scformat"] == "Shellcode" else ".exe"
+
+        sc = self.export_shellcode(**export_args)
         binfile = tempfile.mkstemp(dir=file_dir, suffix=extension)[1]
         sc.to_file(path=binfile)
 
@@ -200,7 +236,7 @@ class MythicClient(ClientABC):
 
         return resolved_token, cleanup_files
 
-    @lru_cache(maxsize=None)
+    @single_flight
     def export_shellcode(self, profile: str, scformat: str = "Shellcode") -> Shellcode:
         mythic = asyncio.run(
             mythic_sdk.login(
@@ -407,25 +443,51 @@ class RemoteBuildClient:
         )
 
         self.mnt_dir = mnt_dir
+        self.forwarding = False
 
     @property
     def docker_env_string(self) -> str:
         return f"tcp://127.0.0.1:{self.fwd_params.docker_bind_port}"
 
     def start_forwarding(self):
+        # the client can be reused across runs (see pdcd serve) in which case the forwards are already up
+        if self.forwarding:
+            return
         self._docker_port_fwd.start()
         self._smb_port_fwd.start()
-        # TODO: check connections are live
-        time.sleep(3)  # TODO: theres prob a better way for this
+        # the session manager plugin only listens on the local port once the session is established
+        for port in [self.fwd_params.docker_bind_port, self.fwd_params.smb_bind_port]:
+            if not wait_for_local_port(port=port, timeout=global_settings.port_forward_timeout):
+                raise Exception(f"Port forward on local port {port} did not start")
+        self.forwarding = True
 
     def stop_forwarding(self):
         self._docker_port_fwd.stop()
         self._smb_port_fwd.stop()
+        self.forwarding = False
 
 
 class DockerClient:
-    def __init__(self, **kwargs):
-        self.docker = docker.from_env(**kwargs)
+    # the default client is created from the environment (see Config.init_default_clients)
+    # additional clients for other Docker daemons are created from the docker connector, which
+    #   provides the daemon URL and how the daemon accesses the shared files
+    def __init__(
+        self,
+        base_url: str = None,
+        mnt_dir: str = None,
+        workers: int = None,
+        mem_budget: str = None,
+        cpu_budget: float = None,
+        **kwargs,
+    ):
+        if base_url:
+            self.docker = docker.DockerClient(base_url=base_url, **kwargs)
+        else:
+            self.docker = docker.from_env(**kwargs)
+        self.mnt_dir = mnt_dir
+        self.workers = workers
+        self.mem_budget = mem_budget
+        self.cpu_budget = cpu_budget
 
     def get_ctr_logs_by_imagename(
         self, image: str, filter_args: dict = None, list_args: dict = None, aws_arn: str = None
@@ -441,7 +503,8 @@ class DockerClient:
         for ctr in ctrs:
             # only consider PDCD generated containers, which are tagged as such
             if ctr.labels.get("pdcd") == "true":
-                values = {"image": ctr.image.tags[0], "logs": ctr.logs()}
+                # containers are created from the image ID so the name the payload used is kept in a label
+                values = {"image": ctr.labels.get("pdcd.image") or ctr.image.tags[0], "logs": ctr.logs()}
                 if aws_arn:
                     if ctr.labels.get("aws_arn") == aws_arn:
                         results[ctr.short_id] = values
@@ -457,10 +520,13 @@ class FileRegistryClient(ClientABC):
     #   @files: CLI token to add the stored file AND the dependency on that files job
     def __init__(self):
         self.__registry = {}  # name: value, payload_name
+        self.__lock = threading.Lock()
 
     def resolve_token(self, token: str, file_dir: str, connector_name: str, **kwargs) -> Tuple[str, list]:
         # token format: < file name >
-        if (entry := self.__registry.get(token, None)) is not None:
+        with self.__lock:
+            entry = self.__registry.get(token, None)
+        if entry is not None:
             routine: Routine
             if (routine := kwargs.get("routine")) is not None:
                 routine.dependencies.append(entry[1])
@@ -474,7 +540,14 @@ class FileRegistryClient(ClientABC):
             raise Exception(f"Unknown stored file {token}")
 
     def upsert_file(self, name: str, value: str, payload: str):
-        self.__registry[name] = (value, payload)
+        with self.__lock:
+            self.__registry[name] = (value, payload)
+
+    def payload_for(self, name: str) -> Optional[str]:
+        """name of the payload that stored a file"""
+        with self.__lock:
+            entry = self.__registry.get(name, None)
+        return entry[1] if entry is not None else None
 
 
 class ArtifactClient(ClientABC):
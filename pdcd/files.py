@@ -1,22 +1,35 @@
 from abc import ABC, abstractmethod
 from impacket.smbconnection import SMBConnection, SessionError
-from typing import List, TYPE_CHECKING
+from impacket.smb3structs import FILE_READ_DATA, FILE_SHARE_READ, FILE_SHARE_WRITE, FILE_WRITE_DATA
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
 from dataclasses import dataclass
+import contextlib
+import os
 import pathlib
-import warnings
+import shutil
+import threading
+import time
+import uuid
 import concurrent.futures
 
+from .sync import SyncManifest
+from .settings import global_settings
 from .log import logger
 
 if TYPE_CHECKING:
     from .config import Config
 
+# seconds a pooled SMB session can be idle before it is checked before reuse
+SMB_SESSION_CHECK_INTERVAL = 30
+
 
 @dataclass
 class FSItem:
     # basic wrapper class for a file/directory
     path: str
     is_directory: bool = False
+    size: Optional[int] = None
+    mtime: Optional[float] = None
 
     def __str__(self):
         return self.path if not self.is_directory else f"{self.path}/"
@@ -31,54 +44,264 @@ class FSItem:
         return path
 
 
+class SMBSession:
+    # a logged-in SMB connection with the share's tree connected for as long as the session is open
+    # impacket reference counts tree connects per share (SMB2+), so operations on a session with the tree already
+    #   connected (listPath, putFile, etc.) reuse its tree ID instead of connecting/disconnecting the tree
+    def __init__(self, server: str, port: int, share: str):
+        self.conn = SMBConnection(server, server, "pdcd", port)
+        try:
+            self.conn.login("", "")
+            self.tree_id = self.conn.connectTree(share)
+        except Exception as e:
+            self.conn.close()
+            raise e
+        self.last_used = time.monotonic()
+
+    def alive(self) -> bool:
+        try:
+            self.conn.getSMBServer().echo()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class SMBSessionPool:
+    # This class keeps logged-in SMB sessions to a share so that operations do not each pay for a negotiate,
+    #   login, tree connect and logoff (round trips over the port forward)
+    # A session is used by a single thread at a time. Sessions that were idle for a while are checked with an
+    #   echo before being reused, and sessions that fail with a connection error are dropped, so a session that
+    #   died (e.g. the port forward was restarted) is replaced by a new one
+    def __init__(self, server: str, port: int, share: str, size: int):
+        self.server = server
+        self.port = port
+        self.share = share
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle: List[SMBSession] = []
+
+    def acquire(self) -> SMBSession:
+        while True:
+            with self._lock:
+                session = self._idle.pop() if len(self._idle) > 0 else None
+            if session is None:
+                return SMBSession(server=self.server, port=self.port, share=self.share)
+            if time.monotonic() - session.last_used < SMB_SESSION_CHECK_INTERVAL or session.alive():
+                return session
+            logger.info(f"Replacing dead SMB session to {self.server}:{self.port}")
+            session.close()
+
+    def release(self, session: SMBSession):
+        session.last_used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(session)
+                return
+        session.close()
+
+    @contextlib.contextmanager
+    def session(self) -> Iterator[SMBConnection]:
+        session = self.acquire()
+        try:
+            yield session.conn
+        except SessionError as e:
+            # errors from the server (e.g. file not found) leave the session usable
+            self.release(session)
+            raise e
+        except Exception as e:
+            session.close()
+            raise e
+        else:
+            self.release(session)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for session in idle:
+            session.close()
+
+
+_session_pools: Dict[Tuple[str, int, str], SMBSessionPool] = {}
+_session_pools_lock = threading.Lock()
+
+
+def smb_session(server: str, port: int, share: str):
+    """context manager for a pooled SMB connection to a share"""
+    with _session_pools_lock:
+        key = (server, port, share)
+        if key not in _session_pools:
+            _session_pools[key] = SMBSessionPool(server, port, share, size=global_settings.smb_sessions)
+        pool = _session_pools[key]
+    return pool.session()
+
+
+def close_smb_sessions(port: int = None):
+    """log off pooled sessions, e.g. before the port forward they use is stopped"""
+    with _session_pools_lock:
+        keys = [key for key in _session_pools if port is None or key[1] == port]
+        pools = [_session_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+def byte_ranges(size: int, parts: int, align: int) -> List[Tuple[int, int]]:
+    """split size bytes into up to parts (start, end) ranges; range boundaries are multiples of align"""
+    step = max(align, -(-size // parts // align) * align)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def run_parallel(func: Callable, items: List, workers: int):
+    """call func for each item on a bounded pool of threads; the first error is raised"""
+    if len(items) == 0:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def run_ranges(transfer: Callable[[int, int], None], size: int):
+    """transfer the byte ranges of a file in parallel; the first error is raised"""
+    ranges = byte_ranges(size, parts=global_settings.smb_transfer_workers, align=global_settings.smb_chunk_size)
+    run_parallel(lambda r: transfer(*r), ranges, workers=len(ranges))
+
+
 class SMBOperations:
     # impacket seemed better than smbprotocol and pysmb for basic guest file writing
     #   smbprotocol also has some issues with guest
-    # biggest downside with impacket so far seems to be that connections are very short lived
+    # connections come from a pool of sessions per share (see SMBSessionPool) since impacket connections
+    #   are otherwise short lived
     #
-    # migth wanna come back and make a context handler wrapper for the smbconnection class
-    #
-    # TODO: some way to cleanup repeated conn+login+close stuff + similar method signatures
     # TODO: look into replacing this with GObject + GIO SMB adapter
     #   downside for this however is that is would be prevent use on Windows hosts (for controller)
     @staticmethod
     def write_file(server: str, port: int, share: str, filename: str, content, directory=None):
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
-        tree = conn.connectTree(share)
-        if directory:
-            filename = directory + "\\" + pathlib.Path(filename).name
+        with smb_session(server, port, share) as conn:
+            tree = conn.connectTree(share)
             try:
-                # doesnt look like theres a clean way to create a directory if it already exists without erroring
-                # also cant blind delete beforehand
-                conn.createDirectory(share, directory)
-            except SessionError:
-                pass
-        smb_file = conn.createFile(tree, filename)
-        conn.writeFile(tree, smb_file, content)
-        conn.closeFile(tree, smb_file)
-        conn.close()
+                if directory:
+                    filename = directory + "\\" + pathlib.Path(filename).name
+                    try:
+                        # doesnt look like theres a clean way to create a directory if it already exists without
+                        #   erroring, also cant blind delete beforehand
+                        conn.createDirectory(share, directory)
+                    except SessionError:
+                        pass
+                smb_file = conn.createFile(tree, filename)
+                conn.writeFile(tree, smb_file, content)
+                conn.closeFile(tree, smb_file)
+            finally:
+                conn.disconnectTree(tree)
 
     @staticmethod
-    def get_file(server: str, port: int, share: str, src: str, dst: str):
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
+    def write_stream(server: str, port: int, share: str, filename: str, fileobj, directory=None):
+        """write a file from a file-like object; filename can contain subdirectories (separated by "/")"""
+        with smb_session(server, port, share) as conn:
+            parts = ([directory] if directory else []) + filename.split("/")
+            for i in range(1, len(parts)):
+                try:
+                    conn.createDirectory(share, "\\".join(parts[:i]))
+                except SessionError:
+                    pass
+            # impacket calls read() with the max write size until it returns nothing
+            conn.putFile(share, "\\".join(parts), fileobj.read)
 
+    @staticmethod
+    def write_file_ranges(server: str, port: int, share: str, src: str, filename: str, directory=None):
+        """
+        upload a large local file by writing byte ranges of it in parallel, each over its own pooled session
+
+        :param src: local file
+        :param filename: remote file; can contain subdirectories (separated by "/")
+        :param directory: remote directory for the file
+        """
+        parts = ([directory] if directory else []) + filename.split("/")
+        path = "\\".join(parts)
+        with smb_session(server, port, share) as conn:
+            for i in range(1, len(parts)):
+                try:
+                    conn.createDirectory(share, "\\".join(parts[:i]))
+                except SessionError:
+                    pass
+            # the file is created (or truncated) once, then each range is written through its own handle
+            tree = conn.connectTree(share)
+            try:
+                conn.closeFile(tree, conn.createFile(tree, path))
+            finally:
+                conn.disconnectTree(tree)
+
+        def write_range(start: int, end: int):
+            with smb_session(server, port, share) as conn, open(src, "rb") as f:
+                tree = conn.connectTree(share)
+                fid = None
+                try:
+                    fid = conn.openFile(
+                        tree, path, desiredAccess=FILE_WRITE_DATA, shareMode=FILE_SHARE_READ | FILE_SHARE_WRITE
+                    )
+                    f.seek(start)
+                    offset = start
+                    while offset < end and len(data := f.read(min(global_settings.smb_chunk_size, end - offset))) > 0:
+                        conn.writeFile(tree, fid, data, offset)
+                        offset += len(data)
+                finally:
+                    if fid is not None:
+                        conn.closeFile(tree, fid)
+                    conn.disconnectTree(tree)
+
+        run_ranges(write_range, size=os.path.getsize(src))
+
+    @staticmethod
+    def read_file_ranges(server: str, port: int, share: str, src: str, dst: str, size: int):
+        """download a large remote file by reading byte ranges of it in parallel, each over its own pooled session"""
+        # the local file is sized up front so each range can be written in place
         with open(dst, "wb") as f:
-            conn.getFile(share, src, f.write)
+            f.truncate(size)
+
+        def read_range(start: int, end: int):
+            with smb_session(server, port, share) as conn, open(dst, "r+b") as f:
+                tree = conn.connectTree(share)
+                fid = None
+                try:
+                    fid = conn.openFile(
+                        tree, src, desiredAccess=FILE_READ_DATA, shareMode=FILE_SHARE_READ | FILE_SHARE_WRITE
+                    )
+                    f.seek(start)
+                    offset = start
+                    while offset < end:
+                        length = min(global_settings.smb_chunk_size, end - offset)
+                        data = conn.readFile(tree, fid, offset=offset, bytesToRead=length, singleCall=False)
+                        if len(data) == 0:
+                            raise Exception(f"{src} is shorter than the expected {size} bytes")
+                        f.write(data)
+                        offset += len(data)
+                finally:
+                    if fid is not None:
+                        conn.closeFile(tree, fid)
+                    conn.disconnectTree(tree)
+
+        run_ranges(read_range, size=size)
 
-        conn.close()
+    @staticmethod
+    def get_file(server: str, port: int, share: str, src: str, dst: str):
+        with smb_session(server, port, share) as conn:
+            with open(dst, "wb") as f:
+                conn.getFile(share, src, f.write)
 
     @staticmethod
     def list_directory(server: str, port: int, share: str, directory: str = None) -> List[FSItem]:
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
-
         if directory and directory[-1] == "/":  # remove trailing slash
             directory = directory[0 : len(directory) - 1]
 
         path = "*" if not directory else f"{directory}/*"
-        items = conn.listPath(share, path)
+        with smb_session(server, port, share) as conn:
+            items = conn.listPath(share, path)
 
         files = []
         for item in items:
@@ -86,57 +309,73 @@ class SMBOperations:
             if longname != "." and longname != "..":  # "." and ".." always in results
                 if directory:
                     longname = directory + "/" + longname  # directory not included in returned file object
-                files.append(FSItem(path=longname, is_directory=item.is_directory() != 0))  # directory = 16, file = 0
-        conn.close()
+                files.append(
+                    FSItem(
+                        path=longname,
+                        is_directory=item.is_directory() != 0,  # directory = 16, file = 0
+                        size=item.get_filesize(),
+                        mtime=item.get_mtime_epoch(),
+                    )
+                )
         return files
 
     @staticmethod
     def delete_file(server: str, port: int, share: str, path: str):
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
-
-        conn.deleteFile(share, path)
-        conn.close()
+        with smb_session(server, port, share) as conn:
+            conn.deleteFile(share, path)
 
     @staticmethod
     def delete_empty_directory(server: str, port: int, share: str, directory: str):
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
+        with smb_session(server, port, share) as conn:
+            conn.deleteDirectory(share, directory)
 
-        conn.deleteDirectory(share, directory)
-        conn.close()
+    @staticmethod
+    def walk_directory(server: str, port: int, share: str, directory: str) -> List[FSItem]:
+        """
+        list all files and subdirectories under a directory; subdirectories are listed in parallel as they are found
+        (up to the smb_sessions setting), and a directory is always listed before its contents
+        """
+        items = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=global_settings.smb_sessions) as pool:
+            pending = {pool.submit(SMBOperations.list_directory, server, port, share, directory)}
+            while len(pending) > 0:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for item in future.result():
+                        items.append(item)
+                        if item.is_directory:
+                            pending.add(pool.submit(SMBOperations.list_directory, server, port, share, item.path))
+        return items
 
     @staticmethod
     def empty_directory(server: str, port: int, share: str, directory: str):
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
+        """delete the files in a directory tree in parallel, then its subdirectories from the deepest level up"""
+        items = SMBOperations.walk_directory(server, port, share, directory)
+        workers = global_settings.smb_sessions
+        files = [item.path for item in items if not item.is_directory]
+        run_parallel(lambda path: SMBOperations.delete_file(server, port, share, path), files, workers=workers)
 
-        dir_files = SMBOperations.list_directory(server, port, share, directory)
-        for dir_file in dir_files:
-            if dir_file.is_directory:
-                SMBOperations.empty_directory(server, port, share, dir_file.path)
-                SMBOperations.delete_empty_directory(server, port, share, dir_file.path)
-            else:
-                SMBOperations.delete_file(server, port, share, dir_file.path)
+        levels: Dict[int, List[str]] = {}
+        for item in items:
+            if item.is_directory:
+                levels.setdefault(item.path.count("/"), []).append(item.path)
+        for depth in sorted(levels, reverse=True):
+            run_parallel(
+                lambda path: SMBOperations.delete_empty_directory(server, port, share, path),
+                levels[depth],
+                workers=workers,
+            )
 
     @staticmethod
     def delete_directory(server: str, port: int, share: str, directory: str):
         """recursively empties a directory then deletes it"""
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
-
         SMBOperations.empty_directory(server, port, share, directory)
         SMBOperations.delete_empty_directory(server, port, share, directory)
-        conn.close()
 
     @staticmethod
     def create_directory(server: str, port: int, share: str, directory: str):
-        """recursively empties a directory then deletes it"""
-        conn = SMBConnection(server, server, "pdcd", port)
-        conn.login("", "")
-
-        conn.createDirectory(share, directory)
-        conn.close()
+        with smb_session(server, port, share) as conn:
+            conn.createDirectory(share, directory)
 
 
 class LocalOperations:
@@ -145,6 +384,21 @@ class LocalOperations:
         with pathlib.Path(filename).open("wb") as f:
             f.write(content)
 
+    @staticmethod
+    def write_stream(fileobj, filename: str):
+        # the stream is written to a temporary file that replaces the target once it was read completely, so an
+        #   interrupted stream does not leave a truncated file behind
+        path = pathlib.Path(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with tmp_path.open("wb") as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(tmp_path, path)
+        except BaseException as e:
+            tmp_path.unlink(missing_ok=True)
+            raise e
+
     @staticmethod
     def list_files_in_directory(directory: str) -> List[str]:
         return [f.resolve().as_posix() for f in pathlib.Path(directory).glob("**/*") if f.is_file()]
@@ -161,10 +415,16 @@ class FileManager(ABC):
     def write(self, content, filename):
         pass
 
+    @abstractmethod
+    def write_stream(self, fileobj, filename):
+        pass
+
 
 class SMBFileManager(FileManager):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # what was copied to/from the remote directory during the run (see SyncManifest)
+        self.manifest = SyncManifest()
 
     def _do_smb_op(self, op: str, *args, **kwargs):
         logger.info(
@@ -183,15 +443,56 @@ class SMBFileManager(FileManager):
         self._do_smb_op(
             "write_file", filename=filename, directory=self._config.remote_client.fwd_params.smb_uuid, content=content
         )
+        self.manifest.record_write(pathlib.Path(filename).name, size=len(content))
 
-    def upload(self, filename: str):
-        self.write(filename=filename, content=pathlib.Path(filename).read_bytes())
+    def write_stream(self, fileobj, filename: str):
+        self._do_smb_op(
+            "write_stream", filename=filename, directory=self._config.remote_client.fwd_params.smb_uuid, fileobj=fileobj
+        )
+
+    def upload(self, filename: str, name: str = None):
+        """upload a local file; name is its path in the remote directory (default: the file name)"""
+        path = pathlib.Path(filename)
+        name = name if name is not None else path.name
+        # uploads are streamed in chunks; large files are also split into ranges that are written in parallel
+        if path.stat().st_size >= global_settings.smb_parallel_threshold:
+            self._do_smb_op(
+                "write_file_ranges",
+                src=path.as_posix(),
+                filename=name,
+                directory=self._config.remote_client.fwd_params.smb_uuid,
+            )
+        else:
+            with path.open("rb") as f:
+                self.write_stream(fileobj=f, filename=name)
+        self.manifest.record_copy(name, path)
+
+    def record_local_copy(self, filename: str, name: str):
+        """record a local file that is already on the share (e.g. an artifact in the shared directory)"""
+        self.manifest.record_copy(name, pathlib.Path(filename))
+
+    def upload_changed(self, files: List[pathlib.Path]) -> int:
+        """upload the files (in the file directory) that are not already on the share; returns the number uploaded"""
+        # files in subdirectories keep their path relative to the file directory
+        names = {f: f.relative_to(self._config.file_dir).as_posix() for f in files}
+        changed = [f for f in files if self.manifest.changed(names[f], f)]
+        if len(changed) == 0:
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._config.workers) as pool:
+            futures = {pool.submit(self.upload, f.as_posix(), name=names[f]): f for f in changed}
+            for future in concurrent.futures.as_completed(futures):
+                if (e := future.exception()) is not None:
+                    logger.error(f"Could not upload {futures[future].name}: {e}")
+                    raise e
+        return len(changed)
 
     def dir(self, directory: str = None) -> List[str]:
         files = self._do_smb_op("list_directory", directory=directory)
         return [str(f.path) for f in files]
 
-    def download(self, src: str, dst: str):
+    def download(self, src: str, dst: str, size: int = None):
+        if size is not None and size >= global_settings.smb_parallel_threshold:
+            return self._do_smb_op("read_file_ranges", src=src, dst=dst, size=size)
         return self._do_smb_op("get_file", src=src, dst=dst)
 
     def rmdir(self, directory: str):
@@ -206,17 +507,28 @@ class SMBFileManager(FileManager):
             directory=directory,
         )
 
+    def walk(self, directory: str) -> List[FSItem]:
+        return self._do_smb_op(
+            "walk_directory",
+            directory=directory,
+        )
+
     def mkdir(self, directory: str):
         return self._do_smb_op(
             "create_directory",
             directory=directory,
         )
 
-    def sync_local_to_remote(self):
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._config.workers)
-        for local_file in LocalOperations.list_files_in_directory(self._config.file_dir):
-            pool.submit(self.upload, local_file)
-        pool.shutdown(wait=True)
+    def sync_local_to_remote(self, files: List[pathlib.Path]):
+        """upload the input files of a run; other files in the file directory (e.g. old outputs) are not needed"""
+        uploaded = self.upload_changed(files)
+        logger.info(f"Uploaded {uploaded} of {len(files)} input files to the remote share")
+        # a single walk of the remote directory records the state of the uploaded files on the share
+        remote_dir = self._config.remote_client.fwd_params.smb_uuid
+        for smb_file in self.walk(remote_dir):  # type: FSItem
+            if not smb_file.is_directory:
+                name = smb_file.path[len(remote_dir) + 1 :]
+                self.manifest.record_remote(name, size=smb_file.size, mtime=smb_file.mtime)
 
     def sync_remote_to_local(self):
         pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._config.workers)
@@ -227,12 +539,21 @@ class SMBFileManager(FileManager):
         # full roundtrip test (local->remote then remote->local) had ~45% time decrease for 1->4 workers
         #   ~25% decrease for 1->2 workers
         # sample size: a few runs
-        for smb_file in self.ls(self._config.remote_client.fwd_params.smb_uuid):  # type: FSItem
-            if not smb_file.is_directory:
-                pool.submit(self.download, src=smb_file.path, dst=f"{self._config.file_dir}/{smb_file.name}")
-            else:
-                warnings.warn(f'remote directory downloading not yet supported (directory="{smb_file.path}")')
+        # files that were uploaded during the run (inputs and artifacts, which are written locally first) and did
+        #   not change on the share are already in the file directory
+        # subdirectories are downloaded with the same structure under the file directory
+        remote_dir = self._config.remote_client.fwd_params.smb_uuid
+        downloads = 0
+        for smb_file in self.walk(remote_dir):  # type: FSItem
+            name = smb_file.path[len(remote_dir) + 1 :]
+            dst = pathlib.Path(self._config.file_dir, name)
+            if smb_file.is_directory:
+                dst.mkdir(parents=True, exist_ok=True)
+            elif self.manifest.is_new(name, size=smb_file.size, mtime=smb_file.mtime):
+                pool.submit(self.download, src=smb_file.path, dst=dst.as_posix(), size=smb_file.size)
+                downloads += 1
         pool.shutdown(wait=True)
+        logger.info(f"Downloaded {downloads} new files from the remote share")
 
 
 class LocalFileManager(FileManager):
@@ -243,6 +564,10 @@ class LocalFileManager(FileManager):
         file_path = self._config.file_dir + "/" + filename
         LocalOperations.write_file(content, file_path)
 
+    def write_stream(self, fileobj, filename: str):
+        file_path = self._config.file_dir + "/" + filename
+        LocalOperations.write_stream(fileobj, file_path)
+
 
 def set_fm_for_config(config: "Config"):
     # TODO: this will need to be changed when additional file managers are added
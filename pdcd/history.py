@@ -0,0 +1,52 @@
+import json
+import pathlib
+import threading
+from typing import TYPE_CHECKING, Any
+
+from .log import logger
+
+if TYPE_CHECKING:
+    from .routines import Routine
+
+
+class RoutineHistory:
+    # This class persists measurements from previous runs (e.g. how long a routine took) so they can be
+    #   used to make scheduling decisions in later runs
+    # Entries are keyed by payload name + image since the same payload name can be reused across configs
+    #   for unrelated jobs
+    def __init__(self, path: pathlib.Path):
+        self._path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        if self._path.exists():
+            try:
+                self._entries = json.loads(self._path.read_text())
+            except (ValueError, OSError) as e:
+                # history is only an optimization so a bad file should not prevent a run
+                logger.warning(f"Ignoring unreadable history file {self._path.as_posix()}: {e}")
+
+    @staticmethod
+    def key(routine: "Routine") -> str:
+        return f"{routine.name}::{routine.image}"
+
+    def get(self, routine: "Routine", metric: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._entries.get(self.key(routine), {}).get(metric, default)
+
+    def values(self, metric: str) -> list:
+        """all recorded values of a metric across routines"""
+        with self._lock:
+            return [entry[metric] for entry in self._entries.values() if metric in entry]
+
+    def record(self, routine: "Routine", **metrics):
+        with self._lock:
+            self._entries.setdefault(self.key(routine), {}).update(metrics)
+
+    def save(self):
+        with self._lock:
+            try:
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                self._path.write_text(json.dumps(self._entries, indent=2, sort_keys=True))
+            except OSError as e:
+                logger.warning(f"Could not write history file {self._path.as_posix()}: {e}")
@@ -0,0 +1,82 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from docker.client import DockerClient as DockerSDKClient
+from docker.errors import ImageNotFound
+
+from .log import logger
+
+
+@dataclass(frozen=True)
+class ImageInfo:
+    # id is used to create containers so all routines of a run use the same image even if the tag is moved
+    id: str
+    os: str
+    working_dir: str
+    entrypoint: Tuple[str, ...] = ()
+    cmd: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_attrs(cls, attrs: dict) -> "ImageInfo":
+        image_config = attrs.get("Config") or {}
+        return cls(
+            id=attrs["Id"],
+            os=attrs.get("Os", "linux").lower(),  # this capitalization...
+            working_dir=image_config.get("WorkingDir") or "",
+            entrypoint=tuple(image_config.get("Entrypoint") or []),
+            cmd=tuple(image_config.get("Cmd") or []),
+        )
+
+
+def normalize_image_name(image: str) -> str:
+    """add the implicit "latest" tag to an image name"""
+    if image.startswith("sha256:") or "@" in image or ":" in image.split("/")[-1]:
+        return image
+    return f"{image}:latest"
+
+
+class ImageIndex:
+    # This class resolves image names for a single Docker daemon for the duration of a run
+    # All tags/digests on the daemon are listed with a single call the first time an image is looked up,
+    #   then only the images that are actually used are inspected (once each)
+    # A name is resolved once per run, so a tag that is moved (e.g. rebuilt) mid-run does not change
+    #   the image for routines that have not started yet
+    def __init__(self, docker: DockerSDKClient):
+        self._docker = docker
+        self._lock = threading.Lock()
+        self._ids: Optional[Dict[str, str]] = None  # name -> image ID
+        self._images: Dict[str, Optional[ImageInfo]] = {}  # name -> image
+        self._inspected: Dict[str, ImageInfo] = {}  # image ID -> image
+
+    def _load(self):
+        self._ids = {}
+        for summary in self._docker.api.images():
+            for name in (summary.get("RepoTags") or []) + (summary.get("RepoDigests") or []):
+                self._ids[name] = summary["Id"]
+        logger.info(f"Indexed {len(self._ids)} image names on Docker daemon {self._docker.api.base_url}")
+
+    def _inspect(self, image: str) -> Optional[ImageInfo]:
+        image_id = self._ids.get(normalize_image_name(image), image)
+        if image_id not in self._inspected:
+            # names that are not in the list (e.g. short IDs) are inspected directly
+            try:
+                info = ImageInfo.from_attrs(self._docker.api.inspect_image(image_id))
+            except ImageNotFound:
+                return None
+            self._inspected[info.id] = info
+            image_id = info.id
+        return self._inspected[image_id]
+
+    def get(self, image: str) -> Optional[ImageInfo]:
+        with self._lock:
+            if image not in self._images:
+                if self._ids is None:
+                    self._load()
+                self._images[image] = self._inspect(image)
+            return self._images[image]
+
+    def forget(self, image: str):
+        """look an image up again the next time it is used, e.g. after it was pulled"""
+        with self._lock:
+            self._images.pop(image, None)
+            self._ids = None
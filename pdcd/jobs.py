@@ -1,92 +1,652 @@
+import bisect
 import concurrent.futures
-from typing import List
-from dataclasses import dataclass, field
+import pathlib
+import statistics
+import threading
+import time
+from typing import List, Dict, Optional, Set, Tuple, Union
+from dataclasses import dataclass
 
-from .routines import Routine
+from .routines import Routine, RoutineResult, RoutineStatus
+from .matrix import MatrixRoutine
+from .history import RoutineHistory
+from .resources import Resources, parse_memory
+from .endpoints import DockerPool, DockerEndpoint
+from .cache import BuildCache
+from .journal import RunJournal
+from .pulls import ImagePuller
+from .settings import global_settings
+from .log import logger
 
+# weight used for routines without any recorded duration when there is no history at all
+DEFAULT_ROUTINE_WEIGHT = 1.0
+# CPUs assumed for a routine that has no recorded usage
+DEFAULT_ROUTINE_CPUS = 1.0
+# learned peak memory is padded since usage varies between runs
+LEARNED_MEMORY_MARGIN = 1.25
+# lower bound for learned CPU usage so mostly idle routines still count against the budget
+MIN_LEARNED_CPUS = 0.1
 
-def routine_names(routines: List[Routine]):
-    return [routine.name for routine in routines]
-
-
-@dataclass
-class JobBatch:
-    routines: List[Routine]
 
-    @property
-    def names(self):
-        return routine_names(routines=self.routines)
+def routine_names(routines: List[Union[Routine, MatrixRoutine]]):
+    return [routine.name for routine in routines]
 
 
 @dataclass
 class JobHandler:
-    # this class implements a very naive batching queue for jobs based on the
-    # dependencies in the jobs
-    # while the batching has a short circuit for cyclical dependencies, users should still
-    #   make an effort to avoid cyclical references
-    routines: List[Routine]
+    # this class schedules jobs as a DAG based on the dependencies in the jobs
+    # a routine is started as soon as all of its own dependencies finish rather than
+    #   waiting for every routine in a "level" of the graph to finish
+    # workers is a global cap on the number of routines running at once
+    # when more routines are ready than there are free workers, the ones with the highest priority
+    #   go first, then the ones on the longest remaining dependency chain (critical path)
+    # routines that depend (directly or not) on a routine that did not succeed are skipped
+    #   in fail-fast mode, nothing new is started after the first failure and running containers can
+    #   optionally be stopped
+    # when a Docker pool is provided, each routine is placed on a Docker endpoint that has its image and
+    #   where its expected memory/CPU footprint fits in what is left of the endpoint's resource budget,
+    #   in addition to the workers cap
+    # when a build cache is provided, routines whose inputs are unchanged are restored from the cache
+    #   rather than run, and identical routines within a run only run once
+    # when a run journal is provided, completed routines are recorded in it and routines that completed in a
+    #   previous (resumed) run are not run again
+    # routines that run longer than their timeout are stopped (which frees their worker) and reported as failed
+    # a matrix payload is a single node in the graph; its routines are created one at a time (on the executor,
+    #   since resolving tokens can be slow) when a worker is available and the node completes once all of them have
+    # when images are being pulled, routines wait for their own image only and fail if it could not be pulled
+    routines: List[Union[Routine, MatrixRoutine]]
     workers: int = 2
-    batches: List[JobBatch] = field(default_factory=list, init=False)
+    history: Optional[RoutineHistory] = None
+    fail_fast: bool = False
+    stop_running: bool = False
+    pool: Optional[DockerPool] = None
+    cache: Optional[BuildCache] = None
+    journal: Optional[RunJournal] = None
+    pulls: Optional[ImagePuller] = None
 
     def __post_init__(self):
         names = routine_names(routines=self.routines)
         if len(names) > len(list(set(names))):
             raise Exception("duplicate routine names")
-        self.init_batches()
+        self.validate_matrix_names()
+        self.results: Dict[str, RoutineResult] = {}
         self.validate_deps_exist()
-
-    @property
-    def names_in_current_batches(self) -> List[str]:
-        return [name for batch in self.batches for name in batch.names]
+        self.init_graph()
 
     @property
     def all_routine_names(self) -> List[str]:
         return routine_names(routines=self.routines)
 
+    def validate_matrix_names(self):
+        # results, the journal, history and the cache are all keyed by routine name so the routines of a matrix
+        #   cannot share a name with any other routine (e.g. "a" with {x: b-c} and "a-b" with {x: c})
+        names = set(self.all_routine_names)
+        for routine in self.routines:
+            if isinstance(routine, MatrixRoutine):
+                for name in routine.child_names():
+                    if name in names:
+                        raise Exception(f"Routine name {name} of matrix payload {routine.name} is already used")
+                    names.add(name)
+
     def validate_deps_exist(self):
         all_dep_names = []
         [all_dep_names.extend(routine.dependencies) for routine in self.routines]
         if not set(all_dep_names).issubset(set(self.all_routine_names)):
             raise Exception("Dependency names do not match payload names")
 
-    def process_next_batch(self):
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
-        for routine in self.batches[0].routines:
-            p = pool.submit(routine.run_ctr)
-        pool.shutdown(wait=True)
-        self.batches.pop(0)
-
-    def init_batches(self):
-        nodep_list = []
-        dep_list = []
-        # split routines into ones that have dependencies vs those that dont
+    def init_graph(self):
+        # dependencies can contain duplicates (e.g. when the file registry adds a dependency that was also
+        #   provided explicitly) so they are de-duplicated before counting
+        self.dependents: Dict[str, List[Union[Routine, MatrixRoutine]]] = {
+            routine.name: [] for routine in self.routines
+        }
+        self.dependency_counts: Dict[str, int] = {}
         for routine in self.routines:
-            (nodep_list if len(routine.dependencies) == 0 else dep_list).append(routine)
-        # first batch is always the list of items without dependencies
-        self.batches.append(JobBatch(routines=nodep_list))
-
-        # loop over the remaining routines
-        #   if any have all their deps met by an existing batch, add them to a new batch and
-        #   remove them from the list
-        # this should handle extrememly nested dependencies as long as they aren't cyclical
-        loop_ct = 0
-        while len(dep_list) != 0:
-            # TODO: check that dependency actually exists or actually make a DAG
-            if loop_ct > 100:
-                raise Exception("Excessive nesting in dependencies")
-            batch = JobBatch(routines=[])
-            routines = dep_list.copy()
-            for routine in routines:
-                if all([dep in self.names_in_current_batches for dep in routine.dependencies]):
-                    batch.routines.append(routine)
-                    dep_list.remove(routine)
-
-            self.batches.append(batch)
-            loop_ct += 1
+            dependencies = set(routine.dependencies)
+            self.dependency_counts[routine.name] = len(dependencies)
+            for dependency in dependencies:
+                self.dependents[dependency].append(routine)
+        self.validate_acyclic()
+        self.init_priorities()
+
+    def validate_acyclic(self):
+        # walk the graph without running anything (Kahn's algorithm)
+        # any routine that never becomes ready is part of (or depends on) a cycle
+        counts = dict(self.dependency_counts)
+        ready = [name for name, count in counts.items() if count == 0]
+        self.topological_order: List[str] = []
+        while len(ready) > 0:
+            name = ready.pop()
+            self.topological_order.append(name)
+            for dependent in self.dependents[name]:
+                counts[dependent.name] -= 1
+                if counts[dependent.name] == 0:
+                    ready.append(dependent.name)
+
+        if len(self.topological_order) != len(self.routines):
+            cyclic = [name for name, count in counts.items() if count > 0]
+            raise Exception(f"Cyclical dependencies between payloads: {', '.join(cyclic)}")
+
+    def default_weight(self) -> float:
+        # routines that have never run are assumed to take a typical amount of time
+        known = self.history.values("duration") if self.history is not None else []
+        return statistics.median(known) if len(known) > 0 else DEFAULT_ROUTINE_WEIGHT
+
+    def routine_weight(self, routine: Routine, default: float) -> float:
+        """expected duration of a routine based on previous runs"""
+        if self.history is None:
+            return default
+        return self.history.get(routine, "duration", default)
+
+    def init_priorities(self):
+        # the rank of a routine is its own weight plus the largest rank of its dependents, i.e. the expected
+        #   time from starting the routine until the end of the longest chain that it gates
+        # user-provided priorities are propagated to dependencies since a routine cannot start before them
+        by_name = {routine.name: routine for routine in self.routines}
+        default_weight = self.default_weight()
+        self.ranks: Dict[str, float] = {}
+        self.priorities: Dict[str, int] = {}
+        for name in reversed(self.topological_order):
+            dependents = self.dependents[name]
+            self.ranks[name] = self.routine_weight(by_name[name], default_weight) + max(
+                [self.ranks[dependent.name] for dependent in dependents], default=0
+            )
+            self.priorities[name] = max(
+                [by_name[name].priority] + [self.priorities[dependent.name] for dependent in dependents]
+            )
+
+    def _sort_key(self, index: int, routine: Routine) -> tuple:
+        # the ready list is sorted ascending so larger values are negated; config order breaks ties
+        return -self.priorities[routine.name], -self.ranks[routine.name], index
+
+    def routine_request(self, routine: Routine) -> Resources:
+        """expected footprint of a routine; learned values from previous runs are preferred over the limits"""
+        memory = parse_memory(routine.mem_limit if routine.mem_limit is not None else global_settings.docker_mem_limit)
+        # a routine cannot use more CPUs than its limit
+        cpu_limit = routine.cpu_limit
+        cpus = cpu_limit if cpu_limit is not None else DEFAULT_ROUTINE_CPUS
+        if self.history is not None:
+            # the learned memory of a routine that ran out of memory in its last run is too low
+            learned_memory = None if self.history.get(routine, "oom_killed") else self.history.get(routine, "memory")
+            if learned_memory is not None:
+                memory = min(memory, int(learned_memory * LEARNED_MEMORY_MARGIN))
+            if (learned_cpus := self.history.get(routine, "cpus")) is not None:
+                cpus = min(cpus, learned_cpus) if cpu_limit is not None else learned_cpus
+        return Resources(memory=memory, cpus=cpus)
+
+    def next_admissible(self, ready: list) -> Optional[Tuple[Routine, Optional[DockerEndpoint], Resources]]:
+        """pop the highest ranked ready routine that can be placed on an endpoint"""
+        # a matrix stays in the ready list until all of its routines were started; expanding it can complete
+        #   other routines (e.g. when resuming) so a copy of the list is walked
+        for entry in list(ready):
+            if entry not in ready:
+                # removed while an earlier entry was handled (e.g. fail-fast cleared the ready list)
+                continue
+            node = entry[-1]
+            routine = node
+            if isinstance(node, MatrixRoutine):
+                if (routine := self._matrix_head(node)) is None:
+                    if self._stopping:
+                        return None
+                    if node.creating is not None:
+                        # its next routine is still being created
+                        continue
+                    ready.remove(entry)
+                    self._finish_matrix(node)
+                    continue
+
+            if self.pulls is not None and self.pool is not None and not self.pool.has_image(routine.image):
+                if self.pulls.pending(routine.image):
+                    continue
+                if isinstance(node, MatrixRoutine):
+                    node.head = None
+                else:
+                    ready.remove(entry)
+                e = Exception(f'Unknown image "{routine.image}" (pull failed)')
+                self.complete(routine, RoutineResult(name=routine.name, status=RoutineStatus.Failed, exception=e))
+                if self._stopping:
+                    return None
+                continue
+
+            request = self.routine_request(routine)
+            endpoint = None
+            if self.pool is not None and (endpoint := self.pool.place(routine, request)) is None:
+                continue
+            if isinstance(node, MatrixRoutine):
+                node.head = None
+            else:
+                ready.remove(entry)
+            return routine, endpoint, request
+        return None
+
+    def _matrix_head(self, matrix: MatrixRoutine) -> Optional[Routine]:
+        """the next routine of a matrix that needs a worker, created when first needed"""
+        # creating a routine checks its image and resolves its CLI tokens (e.g. exporting shellcode), which can
+        #   take a while, so it is done on the executor and picked up here once it is done
+        while matrix.head is None and not self._stopping:
+            if matrix.creating is not None:
+                variables, future = matrix.creating
+                if not future.done():
+                    return None
+                matrix.creating = None
+                self._creating.discard(future)
+                try:
+                    routine = future.result()
+                    routine.keep_in_volume = matrix.name in self._in_volume
+                    routine.share_artifacts = matrix.name in self._shared
+                    # dependencies added by token resolution must already be satisfied since the routine was not
+                    #   part of the graph
+                    missing = [
+                        dependency
+                        for dependency in set(routine.dependencies)
+                        if dependency not in self.results or not self.results[dependency].succeeded
+                    ]
+                    if len(missing) > 0:
+                        raise Exception(f"dependencies {', '.join(missing)} must be listed in the matrix payload")
+                except Exception as e:
+                    name = matrix.child_name(variables)
+                    logger.error(f"Could not create routine {name} of matrix {matrix.name}: {e}")
+                    if name not in matrix.children:
+                        matrix.children.append(name)
+                    self.results[name] = RoutineResult(name=name, status=RoutineStatus.Failed, exception=e)
+                    if self.fail_fast and not self._stopping:
+                        self.stop()
+                    continue
+
+                matrix.active += 1
+                if self.cache is not None and self.pool is not None:
+                    dependencies = [self._by_name[dependency] for dependency in set(matrix.dependencies)]
+                    self.init_cache_key(routine, dependencies)
+                if not self.dispatch(routine):
+                    matrix.head = routine
+                continue
+
+            if (variables := next(matrix.combinations, None)) is None:
+                matrix.exhausted = True
+                return None
+            if matrix.started is None:
+                matrix.started = time.monotonic()
+            future = self._executor.submit(matrix.create, variables)
+            matrix.creating = (variables, future)
+            self._creating.add(future)
+        return matrix.head
+
+    def _finish_matrix(self, matrix: MatrixRoutine):
+        if not matrix.exhausted or matrix.active > 0:
+            return
+        failed = [name for name in matrix.children if not self.results[name].succeeded]
+        result = RoutineResult(
+            name=matrix.name,
+            status=RoutineStatus.Succeeded if len(failed) == 0 else RoutineStatus.Failed,
+            duration=time.monotonic() - matrix.started if matrix.started is not None else 0,
+        )
+        if len(failed) > 0:
+            result.exception = Exception(f"{len(failed)} of {len(matrix.children)} routines did not succeed")
+        self.complete(matrix, result)
+
+    @property
+    def failed(self) -> bool:
+        return any([not result.succeeded for result in self.results.values()])
+
+    @staticmethod
+    def _failed_result(routine: Routine, e: Exception) -> RoutineResult:
+        logger.error(f"Routine {routine.name} raised an exception: {e}")
+        return RoutineResult(name=routine.name, status=RoutineStatus.Failed, exception=e)
+
+    def _run_routine(self, routine: Routine) -> RoutineResult:
+        # blocking execution, only used without a Docker pool
+        start = time.monotonic()
+        try:
+            result = routine.run_ctr()
+        except Exception as e:
+            result = self._failed_result(routine, e)
+        result.duration = time.monotonic() - start
+        return result
+
+    def _launch_routine(
+        self,
+        routine: Routine,
+        endpoint: DockerEndpoint,
+        done: concurrent.futures.Future,
+        executor: concurrent.futures.Executor,
+    ):
+        start = time.monotonic()
+        try:
+            exit_future = routine.start_ctr(endpoint=endpoint, watch=True)
+        except Exception as e:
+            result = self._failed_result(routine, e)
+            result.duration = time.monotonic() - start
+            done.set_result(result)
+            return
+        # the exit is reported on the event watcher thread so the post-exit work is handed back to the executor
+        exit_future.add_done_callback(lambda f: executor.submit(self._finish_routine, routine, f.result(), done, start))
+
+    def _finish_routine(self, routine: Routine, exit_code: int, done: concurrent.futures.Future, start: float):
+        try:
+            result = routine.finish_ctr(exit_code=exit_code)
+        except Exception as e:
+            result = self._failed_result(routine, e)
+        result.duration = time.monotonic() - start
+        done.set_result(result)
+
+    def start_routine(
+        self, routine: Routine, endpoint: Optional[DockerEndpoint], executor: concurrent.futures.Executor
+    ) -> concurrent.futures.Future:
+        """start a routine without blocking; the returned future resolves to the routine's result"""
+        if endpoint is None:
+            return executor.submit(self._run_routine, routine)
+        # containers are not waited on by a thread; their exits come from the endpoint's event stream
+        done = concurrent.futures.Future()
+        executor.submit(self._launch_routine, routine, endpoint, done, executor)
+        return done
+
+    def skip_dependents(self, routine: Routine):
+        """mark all transitive dependents of a routine as skipped"""
+        stack = list(self.dependents.get(routine.name, []))
+        while len(stack) > 0:
+            dependent = stack.pop()
+            if dependent.name in self.results:
+                continue
+            logger.warning(f"Skipping routine {dependent.name} since dependency {routine.name} did not succeed")
+            self.results[dependent.name] = RoutineResult(name=dependent.name, status=RoutineStatus.Skipped)
+            stack.extend(self.dependents[dependent.name])
+
+    def init_shared_artifacts(self) -> Set[str]:
+        """mark the routines whose artifacts are needed by other routines, i.e. need to be on the remote share"""
+        names = set([routine.name for routine in self.routines if len(self.dependents[routine.name]) > 0])
+        for routine in self.routines:
+            if isinstance(routine, Routine):
+                routine.share_artifacts = routine.name in names
+        return names
+
+    def init_shared_volume(self) -> Set[str]:
+        """mark the routines whose artifacts are only needed by other routines to keep them in the shared volume"""
+        if self.pool is None or self.pool.default.volume is None:
+            return set()
+        # the volume is only on the default endpoint so routines on other endpoints would not see the artifacts
+        if len(self.pool.endpoints) > 1:
+            logger.warning("Copying out all artifacts since the shared volume is not used by all Docker endpoints")
+            return set()
+        names = set([routine.name for routine in self.routines if len(self.dependents[routine.name]) > 0])
+        for routine in self.routines:
+            if isinstance(routine, Routine):
+                routine.keep_in_volume = routine.name in names
+        return names
+
+    def init_cache_keys(self):
+        # keys are computed up front in dependency order since a routine's key includes its dependencies' keys
+        # a matrix has no key of its own (its routines are not known yet) so its dependents are not cached
+        self._cache_keys: Dict[str, Optional[str]] = {}
+        for name in self.topological_order:
+            routine = self._by_name[name]
+            self._cache_keys[name] = None
+            if isinstance(routine, MatrixRoutine):
+                continue
+            dependencies = [self._by_name[dependency] for dependency in set(routine.dependencies)]
+            self._cache_keys[name] = self.init_cache_key(routine, dependencies)
+
+    def init_cache_key(self, routine: Routine, dependencies: list) -> Optional[str]:
+        # routines are not cached when they opted out, have no artifacts to restore (including when they are only
+        #   kept in the shared volume), or depend on a routine that is not cached (its output could differ between
+        #   runs)
+        routine.cache_entry = None
+        if not routine.cache or len(routine.artifacts) == 0 or routine.keep_in_volume:
+            return None
+        if any([self._cache_keys[dependency.name] is None for dependency in dependencies]):
+            return None
+        # the key includes the image ID, which is not known while the image is being pulled
+        if not self.pool.has_image(routine.image):
+            return None
+
+        # dependency artifacts are covered by the dependency keys
+        dependency_artifacts = [
+            pathlib.PurePath(artifact).name for dependency in dependencies for artifact in dependency.artifacts
+        ]
+        key = self.cache.key(
+            image_id=self.pool.image_id(routine.image),
+            cli=routine.cli,
+            artifacts=routine.artifacts,
+            inputs=[p for p in routine.input_paths if p.name not in dependency_artifacts],
+            dependency_keys=[self._cache_keys[dependency.name] for dependency in dependencies],
+        )
+        routine.cache_entry = self.cache.entry(key)
+        return key
+
+    def _restore_routine(self, routine: Routine) -> RoutineResult:
+        logger.info(f"Restoring routine {routine.name} from build cache (key {routine.cache_entry.key[:12]})")
+        start = time.monotonic()
+        try:
+            result = routine.restore_from_cache()
+        except Exception as e:
+            result = self._failed_result(routine, e)
+        result.duration = time.monotonic() - start
+        return result
+
+    def make_ready(self, routine: Union[Routine, MatrixRoutine]):
+        if isinstance(routine, MatrixRoutine) or not self.dispatch(routine):
+            bisect.insort(self._ready, (*self._sort_key(self._indexes[routine.name], routine), routine))
+
+    def dispatch(self, routine: Routine) -> bool:
+        """handle a routine that does not need a worker (resumed, cached or identical to another routine)"""
+        if self.journal is not None and self.journal.is_completed(routine):
+            logger.info(f"Routine {routine.name} already completed in the resumed run")
+            artifacts = list(self.journal.completed[routine.name]["artifacts"].keys())
+            result = RoutineResult(
+                name=routine.name, status=RoutineStatus.Succeeded, artifacts=artifacts, duration=0, resumed=True
+            )
+            self.complete(routine, result)
+            return True
+
+        entry = routine.cache_entry
+        if entry is not None:
+            if entry.exists:
+                # restoring does not use a container so it does not count against the workers
+                future = self._executor.submit(self._restore_routine, routine)
+                self._running[future] = routine
+                self._restoring.add(future)
+                return True
+            # identical routines in the same run only execute once
+            if entry.key in self._leaders:
+                logger.info(f"Routine {routine.name} will reuse the result of {self._leaders[entry.key]}")
+                self._followers.setdefault(entry.key, []).append(routine)
+                return True
+            self._leaders[entry.key] = routine.name
+        return False
+
+    def complete(self, routine: Union[Routine, MatrixRoutine], result: RoutineResult):
+        self.results[routine.name] = result
+
+        followers = []
+        entry = getattr(routine, "cache_entry", None)
+        if entry is not None and self._leaders.get(entry.key) == routine.name:
+            del self._leaders[entry.key]
+            followers = self._followers.pop(entry.key, [])
+            if result.succeeded:
+                entry.commit(artifacts=result.artifacts)
+            else:
+                entry.discard()
+
+        for follower in followers:
+            if result.succeeded:
+                future = self._executor.submit(self._restore_routine, follower)
+                self._running[future] = follower
+                self._restoring.add(future)
+            else:
+                e = Exception(f"identical routine {routine.name} did not succeed")
+                self.complete(follower, RoutineResult(name=follower.name, status=result.status, exception=e))
+
+        if result.succeeded:
+            logger.info(f"Finished routine {routine.name} in {result.duration:.1f}s")
+            if self.history is not None and not (result.cached or result.resumed):
+                self.history.record(routine, duration=result.duration, **self.usage_metrics(result))
+            # artifacts in the shared volume do not outlive the run so those routines run again when resuming
+            if (
+                self.journal is not None
+                and not result.resumed
+                and isinstance(routine, Routine)
+                and not routine.keep_in_volume
+            ):
+                self.journal.record_completed(routine, result)
+            for dependent in self.dependents.get(routine.name, []):
+                self._counts[dependent.name] -= 1
+                if self._counts[dependent.name] == 0 and not self._stopping:
+                    self.make_ready(dependent)
+        else:
+            logger.error(f"Routine {routine.name} did not succeed (status: {result.status.name})")
+            if self.history is not None and result.usage is not None and result.usage.oom_killed:
+                self.history.record(routine, oom_killed=True)
+            self.skip_dependents(routine)
+            if self.fail_fast and not self._stopping:
+                self.stop()
+
+        if isinstance(routine, Routine) and (matrix := routine.matrix) is not None:
+            matrix.active -= 1
+            matrix.cleanup_files.extend(routine.cleanup_files)
+            self._finish_matrix(matrix)
+
+    @staticmethod
+    def usage_metrics(result: RoutineResult) -> dict:
+        """history metrics from the resources a routine used; memory and cpus are used by routine_request"""
+        usage = result.usage
+        if usage is None:
+            return {}
+        metrics = {"block_read": usage.block_read, "block_write": usage.block_write, "oom_killed": usage.oom_killed}
+        if usage.peak_memory is not None:
+            metrics["memory"] = usage.peak_memory
+        if (cpus := usage.cpus(result.duration)) is not None:
+            metrics["cpus"] = max(round(cpus, 2), MIN_LEARNED_CPUS)
+            metrics["cpu_seconds"] = round(usage.cpu_seconds, 1)
+        return metrics
+
+    def next_deadline(self) -> Optional[float]:
+        """seconds until the next running routine times out"""
+        if len(self._deadlines) == 0:
+            return None
+        return max(0.0, min(self._deadlines.values()) - time.monotonic())
+
+    def check_deadlines(self):
+        now = time.monotonic()
+        for future, deadline in list(self._deadlines.items()):
+            if deadline <= now and not future.done():
+                routine = self._running[future]
+                logger.error(f"Routine {routine.name} timed out after {routine.timeout_seconds}s, stopping it")
+                # stopping a container waits for its grace period, which would hold up the scheduler; the executor
+                #   is not used since without a Docker pool its threads are all busy running routines
+                threading.Thread(target=routine.time_out, name=f"pdcd-timeout-{routine.name}", daemon=True).start()
+                # the routine completes once its container has stopped
+                del self._deadlines[future]
+
+    def stop(self):
+        """stop starting new routines (fail-fast)"""
+        self._stopping = True
+        logger.warning("Fail-fast enabled, not starting any new routines")
+        self._ready.clear()
+        if self.stop_running:
+            # containers are stopped on their own threads since each stop waits for the container's grace period
+            for running_routine in self._running.values():
+                threading.Thread(
+                    target=running_routine.stop, name=f"pdcd-stop-{running_routine.name}", daemon=True
+                ).start()
 
     def run(self):
-        while len(self.batches) > 0:
-            self.process_next_batch()
+        self._by_name = {routine.name: routine for routine in self.routines}
+        self._shared = self.init_shared_artifacts()
+        self._in_volume = self.init_shared_volume()
+        if self.cache is not None and self.pool is not None:
+            self.init_cache_keys()
+
+        self._counts = dict(self.dependency_counts)
+        self._indexes = {routine.name: index for (index, routine) in enumerate(self.routines)}
+        self._ready = []
+        self._running: Dict[concurrent.futures.Future, Routine] = {}
+        self._restoring = set()
+        self._placements: Dict[str, Tuple[DockerEndpoint, Resources]] = {}
+        self._leaders: Dict[str, str] = {}  # cache key -> name of the routine producing it
+        self._followers: Dict[str, List[Routine]] = {}  # cache key -> routines waiting on it
+        self._deadlines: Dict[concurrent.futures.Future, float] = {}
+        self._creating: Set[concurrent.futures.Future] = set()  # matrix routines being created
+        self._stopping = False
+
+        # with a Docker pool, the executor only handles starting containers and post-exit work (artifacts,
+        #   cleanup) so it does not need a thread per running container
+        executor_workers = self.workers if self.pool is None else global_settings.scheduler_io_workers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=executor_workers) as executor:
+            self._executor = executor
+            # the initial routines are collected first since making a routine ready can complete it right away
+            #   (e.g. when resuming), which can bring other routines' counts to 0
+            for routine in [routine for routine in self.routines if self._counts[routine.name] == 0]:
+                self.make_ready(routine)
+
+            while len(self._ready) > 0 or len(self._running) > 0:
+                while (len(self._running) - len(self._restoring)) < self.workers and (
+                    admitted := self.next_admissible(self._ready)
+                ) is not None:
+                    routine, endpoint, request = admitted
+                    if endpoint is not None:
+                        self._placements[routine.name] = (endpoint, request)
+                    node_name = routine.matrix.name if routine.matrix is not None else routine.name
+                    logger.info(
+                        f"Starting routine {routine.name} on {endpoint.name if endpoint else 'default endpoint'} "
+                        f"(rank {self.ranks[node_name]:.1f}, request {request})"
+                    )
+                    future = self.start_routine(routine, endpoint, executor)
+                    self._running[future] = routine
+                    if routine.timeout_seconds is not None:
+                        self._deadlines[future] = time.monotonic() + routine.timeout_seconds
+
+                # a finished pull or matrix routine creation can make waiting routines admissible
+                pulls = self.pulls.futures if self.pulls is not None else []
+                done, _ = concurrent.futures.wait(
+                    list(self._running) + pulls + list(self._creating),
+                    timeout=self.next_deadline(),
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                self.check_deadlines()
+                for future in done:
+                    if future not in self._running:
+                        continue
+                    routine = self._running.pop(future)
+                    self._restoring.discard(future)
+                    self._deadlines.pop(future, None)
+                    if routine.name in self._placements:
+                        self.pool.release(*self._placements.pop(routine.name))
+                    self.complete(routine, future.result())
+
+        # routines that were never reached (fail-fast) are also reported as skipped
+        for routine in self.routines:
+            if routine.name not in self.results:
+                self.results[routine.name] = RoutineResult(name=routine.name, status=RoutineStatus.Skipped)
+
+        if self.history is not None:
+            self.history.save()
+
+    def summary(self) -> List[str]:
+        lines = []
+        names = []
+        for routine in self.routines:
+            if isinstance(routine, MatrixRoutine):
+                names.extend(routine.children)
+            names.append(routine.name)
+
+        for name in names:
+            result = self.results.get(name)
+            if result is None:
+                continue
+            line = f"{name}: {result.status.name}"
+            if result.cached:
+                line += " (cached)"
+            if result.resumed:
+                line += " (resumed)"
+            if result.exit_code is not None:
+                line += f" (exit code {result.exit_code})"
+            if result.exception is not None:
+                line += f" ({result.exception})"
+            if result.usage is not None and str(result.usage) != "":
+                line += f" ({result.usage})"
+            if len(result.artifacts) > 0:
+                line += f" [{', '.join(result.artifacts)}]"
+            lines.append(line)
+        return lines
 
     def cleanup_routines(self):
         for routine in self.routines:
@@ -0,0 +1,107 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Optional, Dict, TYPE_CHECKING
+
+from .cache import hash_file, hash_values
+from .log import logger
+
+if TYPE_CHECKING:
+    from .config import PayloadConfig
+    from .routines import Routine, RoutineResult
+
+JOURNAL_NAME = ".pdcd-journal.jsonl"
+
+
+def payload_hash(payload: "PayloadConfig") -> str:
+    return hash_values(json.dumps(payload.__dict__, sort_keys=True, default=str))
+
+
+class RunJournal:
+    # This class keeps an append-only record of a run in the file directory so that an interrupted run can
+    #   be resumed. Each line is a JSON object with an "event" key:
+    #   - run: a run was started
+    #   - resolved: a routine's CLI after token resolution (plus the artifact/dependency changes that tokens
+    #     make and the files created by tokens)
+    #   - completed: a routine finished successfully, with the hashes of its artifacts
+    # When resuming, resolved CLIs are reused as long as the payload is unchanged and the token files still
+    #   exist, and completed routines are skipped as long as their artifacts are unchanged
+    def __init__(self, file_dir: str, resume: bool = False):
+        self.file_dir = pathlib.Path(file_dir)
+        self.path = self.file_dir / JOURNAL_NAME
+        self._lock = threading.Lock()
+        self.resolved: Dict[str, dict] = {}
+        self.completed: Dict[str, dict] = {}
+
+        if resume and self.path.exists():
+            self._load()
+            logger.info(f"Resuming run from {self.path.as_posix()} ({len(self.completed)} completed routines)")
+        else:
+            self.path.write_text("")
+        self._append({"event": "run", "time": time.time()})
+
+    def _load(self):
+        for line in self.path.read_text().splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line can be partially written if the controller died mid-write
+                continue
+            if record.get("event") == "resolved":
+                self.resolved[record["name"]] = record
+            elif record.get("event") == "completed":
+                self.completed[record["name"]] = record
+
+    def _append(self, record: dict):
+        with self._lock:
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def resolved_for(self, payload: "PayloadConfig", digest: str) -> Optional[dict]:
+        """previously resolved values for a payload, if they can be reused"""
+        record = self.resolved.get(payload.name)
+        if record is None or record.get("payload") != digest:
+            return None
+        if not all([pathlib.Path(f).exists() for f in record.get("cleanup_files", [])]):
+            return None
+        return record
+
+    def record_resolved(self, digest: str, routine: "Routine"):
+        # the payload digest needs to be computed before the routine is created since token resolution
+        #   can modify the payload's lists
+        record = {
+            "event": "resolved",
+            "name": routine.name,
+            "payload": digest,
+            "cli": routine.cli,
+            "artifacts": routine.artifacts,
+            "dependencies": routine.dependencies,
+            "cleanup_files": routine.cleanup_files,
+        }
+        self.resolved[routine.name] = record
+        self._append(record)
+
+    def is_completed(self, routine: "Routine") -> bool:
+        record = self.completed.get(routine.name)
+        if record is None or record.get("cli") != routine.cli:
+            return False
+        for artifact, digest in record.get("artifacts", {}).items():
+            artifact_path = self.file_dir / artifact
+            if not artifact_path.exists() or hash_file(artifact_path) != digest:
+                return False
+        return True
+
+    def record_completed(self, routine: "Routine", result: "RoutineResult"):
+        artifacts = {}
+        for artifact in result.artifacts:
+            artifact_path = self.file_dir / artifact
+            # artifacts are always written to the local file directory but a missing one only means the
+            #   routine cannot be reused later
+            artifacts[artifact] = hash_file(artifact_path) if artifact_path.exists() else None
+        record = {"event": "completed", "name": routine.name, "cli": routine.cli, "artifacts": artifacts}
+        self.completed[routine.name] = record
+        self._append(record)
@@ -0,0 +1,120 @@
+import concurrent.futures
+import itertools
+import pathlib
+from dataclasses import replace
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
+
+from .external import FileRegistryClient
+from .routines import cli_tokens
+from .log import logger
+
+if TYPE_CHECKING:
+    from .config import Config, PayloadConfig
+    from .routines import Routine
+
+
+def substitute(value: str, variables: Dict[str, str]) -> str:
+    """replace {key} placeholders; other braces (e.g. in shell commands) are left alone"""
+    for key, variable in variables.items():
+        value = value.replace(f"{{{key}}}", variable)
+    return value
+
+
+def expand_matrix(matrix: Dict[str, List[Any]]) -> Iterator[Dict[str, str]]:
+    """variables for each combination of matrix values"""
+    keys = list(matrix.keys())
+    for values in itertools.product(*[matrix[key] for key in keys]):
+        yield {key: str(value) for key, value in zip(keys, values)}
+
+
+def payload_images(payload: "PayloadConfig") -> List[str]:
+    """distinct images used by a payload's routines"""
+    if payload.matrix is None:
+        return [payload.image]
+    return sorted(set([substitute(payload.image, variables) for variables in expand_matrix(payload.matrix)]))
+
+
+class MatrixRoutine:
+    # This class is a single node in the job graph for a payload with a matrix
+    # The payload is a template that is expanded into one routine per combination of the matrix values but
+    #   the routines are only created (image checked, tokens resolved) once the scheduler is about to run
+    #   them, so the cost of a large matrix grows with the number of workers rather than the number of
+    #   combinations
+    # Other payloads can depend on a matrix payload by its name, in which case they wait for all of its
+    #   routines. The routines of a matrix cannot be depended on individually
+    def __init__(self, payload: "PayloadConfig", config: "Config", factory: Callable[["PayloadConfig"], "Routine"]):
+        if payload.store is not None:
+            raise Exception(f"Payload {payload.name} cannot use store with a matrix")
+        for key, values in payload.matrix.items():
+            if len(values) != len(set(values)):
+                raise Exception(f"Duplicate values for matrix key {key} in payload {payload.name}")
+
+        self.payload = payload
+        self.config = config
+        self.factory = factory
+        self.name = payload.name
+        self.image = payload.image
+        self.priority = payload.priority
+        self.cache = payload.cache
+        self.artifacts: List[str] = []
+        self.dependencies = list(payload.dependencies) + self._registry_dependencies()
+
+        # expansion state for a run
+        self.combinations: Iterator[Dict[str, str]] = self.expand()
+        self.head: Optional["Routine"] = None  # created but not yet started
+        self.creating: Optional[Tuple[Dict[str, str], concurrent.futures.Future]] = None  # variables, routine
+        self.exhausted = False
+        self.active = 0  # created but not yet completed
+        self.children: List[str] = []
+        self.cleanup_files: List[str] = []
+        self.started: Optional[float] = None
+
+    @property
+    def size(self) -> int:
+        size = 1
+        for values in self.payload.matrix.values():
+            size *= len(values)
+        return size
+
+    def _registry_dependencies(self) -> List[str]:
+        # routines add a dependency when resolving a stored file token, but matrix routines are created after
+        #   the graph is built so these dependencies are collected from the template instead
+        dependencies = []
+        for connector_name, args in cli_tokens(self.payload.cli):
+            client = self.config.client_manager.get_client_by_name(connector_name).client
+            if isinstance(client, FileRegistryClient) and (payload := client.payload_for(args)) is not None:
+                dependencies.append(payload)
+        return dependencies
+
+    def expand(self) -> Iterator[Dict[str, str]]:
+        return expand_matrix(self.payload.matrix)
+
+    def child_name(self, variables: Dict[str, str]) -> str:
+        if any([f"{{{key}}}" in self.name for key in variables]):
+            return substitute(self.name, variables)
+        return "-".join([self.name] + list(variables.values()))
+
+    def child_names(self) -> Iterator[str]:
+        """names of all routines of the matrix (without creating them)"""
+        return (self.child_name(variables) for variables in self.expand())
+
+    def create(self, variables: Dict[str, str]) -> "Routine":
+        payload = replace(
+            self.payload,
+            name=self.child_name(variables),
+            image=substitute(self.payload.image, variables),
+            cli=substitute(self.payload.cli, variables),
+            artifacts=[substitute(artifact, variables) for artifact in self.payload.artifacts],
+            dependencies=list(self.dependencies),
+            matrix=None,
+        )
+        logger.info(f"Expanding matrix payload {self.name} into routine {payload.name}")
+        routine = self.factory(payload)
+        routine.matrix = self
+        self.children.append(routine.name)
+        return routine
+
+    def cleanup(self):
+        # token files of the matrix routines are only removed at the end of the run, like other routines
+        for f in self.cleanup_files:
+            pathlib.Path(f).unlink(missing_ok=True)
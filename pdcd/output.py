@@ -0,0 +1,130 @@
+import pathlib
+import selectors
+import socket
+import threading
+from typing import List, Optional
+
+from .log import logger
+
+# bytes read from a stream each time it is ready
+READ_SIZE = 64 * 1024
+# Docker prefixes each chunk of a non-TTY stream with an 8 byte header (stream type, 3 empty bytes, size)
+FRAME_HEADER_SIZE = 8
+
+
+class OutputStream:
+    # output of a single container (or exec) being split into lines
+    def __init__(self, name: str, sock, logfile: pathlib.Path, tty: bool = False):
+        self.name = name
+        self.sock = sock
+        self.tty = tty
+        self._frames = b""
+        self._text = b""
+        # the log file of a routine only contains the output of its last run
+        self._logfile = logfile.open("wb")
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """add raw stream data; returns the complete lines in it"""
+        if self.tty:
+            self._text += data
+        else:
+            self._frames += data
+            while len(self._frames) >= FRAME_HEADER_SIZE:
+                size = int.from_bytes(self._frames[4:FRAME_HEADER_SIZE], "big")
+                if len(self._frames) < FRAME_HEADER_SIZE + size:
+                    break
+                self._text += self._frames[FRAME_HEADER_SIZE : FRAME_HEADER_SIZE + size]
+                self._frames = self._frames[FRAME_HEADER_SIZE + size :]
+
+        *lines, self._text = self._text.split(b"\n")
+        return lines
+
+    def write(self, line: bytes):
+        self._logfile.write(line + b"\n")
+
+    def close(self) -> Optional[bytes]:
+        """close the stream; returns the last line if it did not end with a newline"""
+        remainder = self._text if len(self._text) > 0 else None
+        if remainder is not None:
+            self.write(remainder)
+        self._logfile.close()
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        return remainder
+
+
+class OutputStreamer:
+    # This class follows the output of all running containers from a single thread
+    # Each container's attach socket is registered with a selector, so output is handled as it arrives without
+    #   a blocked thread (or a log request after the run) per container
+    # Lines are written to a log file per routine in the output directory and, optionally, to the console
+    #   prefixed with the routine name
+    def __init__(self, directory: pathlib.Path, console: bool = True):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.console = console
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+        # used to wake up the selector when streams are added or the streamer is closed
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+    def logfile(self, name: str) -> pathlib.Path:
+        return self.directory / f"{name.replace('/', '_')}.log"
+
+    def attach(self, name: str, sock, tty: bool = False):
+        stream = OutputStream(name=name, sock=sock, logfile=self.logfile(name), tty=tty)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pdcd-output", daemon=True)
+                self._thread.start()
+            self._selector.register(sock, selectors.EVENT_READ, stream)
+        self._wakeup_w.send(b"\0")
+
+    def _emit(self, stream: OutputStream, line: bytes):
+        stream.write(line)
+        if self.console:
+            print(f"[{stream.name}] {line.decode(errors='replace').rstrip()}", flush=True)
+
+    def _remove(self, stream: OutputStream):
+        with self._lock:
+            self._selector.unregister(stream.sock)
+        if (remainder := stream.close()) is not None and self.console:
+            print(f"[{stream.name}] {remainder.decode(errors='replace').rstrip()}", flush=True)
+
+    def _run(self):
+        while not self._closing:
+            for key, _ in self._selector.select(timeout=1):
+                stream: Optional[OutputStream] = key.data
+                if stream is None:
+                    self._wakeup_r.recv(READ_SIZE)
+                    continue
+                try:
+                    data = stream.sock.read(READ_SIZE)
+                except Exception as e:
+                    logger.error(f"Could not read output of routine {stream.name}: {e}")
+                    data = b""
+                if data is None:
+                    continue  # nothing available after all
+                if len(data) == 0:
+                    self._remove(stream)
+                    continue
+                for line in stream.feed(data):
+                    self._emit(stream, line)
+
+    def close(self):
+        self._closing = True
+        self._wakeup_w.send(b"\0")
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        with self._lock:
+            streams = [key.data for key in self._selector.get_map().values() if key.data is not None]
+        for stream in streams:
+            self._remove(stream)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
@@ -0,0 +1,90 @@
+import concurrent.futures
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, TYPE_CHECKING
+from docker.utils import parse_repository_tag
+
+from .images import normalize_image_name
+from .settings import global_settings
+from .log import logger, print_and_log
+
+if TYPE_CHECKING:
+    from .endpoints import DockerEndpoint, DockerPool
+
+
+class ImagePuller:
+    # This class pulls the images of a run that are missing from the Docker endpoints before (and while) jobs run
+    # Pulls run in parallel (up to the pull_workers setting) and each finished pull makes its image available
+    #   to the scheduler right away, so jobs start as soon as their own image is ready rather than after all pulls
+    # Images are pulled on every endpoint that does not have them so that all endpoints can run the jobs
+    # When a registry is configured, images are pulled from it and tagged with the name used in the config
+    def __init__(self, pool: "DockerPool", registry: Optional[str] = None, workers: int = 4):
+        self.pool = pool
+        self.registry = registry.rstrip("/") if registry else None
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdcd-pull")
+        self._pending: Dict[str, Set[concurrent.futures.Future]] = {}  # image -> pulls not yet finished
+        self._total = 0
+        self._finished = 0
+
+    @classmethod
+    def start(cls, pool: "DockerPool", images: Iterable[str]) -> "ImagePuller":
+        puller = cls(pool=pool, registry=global_settings.image_registry, workers=global_settings.pull_workers)
+        for image in sorted(set(images)):
+            for endpoint in pool.endpoints:
+                if not endpoint.has_image(image):
+                    puller.submit(endpoint, image)
+        if puller._total > 0:
+            print_and_log(f"Pulling {puller._total} missing image(s)")
+        return puller
+
+    def submit(self, endpoint: "DockerEndpoint", image: str):
+        with self._lock:
+            future = self._executor.submit(self._pull, endpoint, image)
+            self._pending.setdefault(image, set()).add(future)
+            self._total += 1
+        future.add_done_callback(lambda f: self._finish(image, f))
+
+    def _pull(self, endpoint: "DockerEndpoint", image: str):
+        name = normalize_image_name(image)
+        source = f"{self.registry}/{name}" if self.registry is not None else name
+        repository, tag = parse_repository_tag(source)
+        start = time.monotonic()
+        logger.info(f"Pulling image {source} on Docker endpoint {endpoint.name}")
+        # the tag is a digest for names with @ (which the daemon accepts as well)
+        endpoint.docker.api.pull(repository, tag=tag)
+        if source != name and "@" not in name:
+            target_repository, target_tag = parse_repository_tag(name)
+            endpoint.docker.api.tag(source, target_repository, tag=target_tag)
+        # the endpoint's index recorded the image as missing
+        endpoint.images.forget(image)
+        return time.monotonic() - start
+
+    def _finish(self, image: str, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending[image].discard(future)
+            self._finished += 1
+            progress = f"{self._finished}/{self._total}"
+        if future.cancelled():
+            return
+        if (e := future.exception()) is not None:
+            print_and_log(f"Could not pull image {image} ({progress}): {e}")
+        else:
+            print_and_log(f"Pulled image {image} in {future.result():.1f}s ({progress})")
+
+    def pending(self, image: str) -> bool:
+        """whether the image is still being pulled on any endpoint"""
+        with self._lock:
+            return any([not future.done() for future in self._pending.get(image, set())])
+
+    @property
+    def futures(self) -> List[concurrent.futures.Future]:
+        """pulls that have not finished yet"""
+        with self._lock:
+            return [future for futures in self._pending.values() for future in futures if not future.done()]
+
+    def close(self):
+        # pulls that have not started are cancelled; a pull in progress cannot be interrupted
+        for future in self.futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,77 @@
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from docker.client import DockerClient as DockerSDKClient
+from docker.utils import parse_bytes
+
+from .log import logger
+
+
+@dataclass(frozen=True)
+class Resources:
+    # memory is in bytes
+    memory: int = 0
+    cpus: float = 0.0
+
+    def __add__(self, other: "Resources") -> "Resources":
+        return Resources(memory=self.memory + other.memory, cpus=self.cpus + other.cpus)
+
+    def __sub__(self, other: "Resources") -> "Resources":
+        return Resources(memory=self.memory - other.memory, cpus=self.cpus - other.cpus)
+
+    def fits_in(self, other: "Resources") -> bool:
+        return self.memory <= other.memory and self.cpus <= other.cpus
+
+    def __str__(self):
+        return f"{self.memory / 2**30:.2f}GiB/{self.cpus:.2f} CPUs"
+
+
+def parse_memory(value) -> Optional[int]:
+    """convert a Docker-style memory value (e.g. 2G, 512m) to bytes"""
+    if value is None:
+        return None
+    return parse_bytes(value)
+
+
+class ResourceBudget:
+    # This class tracks the resources reserved by running containers against the capacity of a Docker host
+    # Routines are only admitted when their expected footprint fits in what remains so that concurrency
+    #   adapts to the size of the jobs rather than being a fixed count
+    def __init__(self, capacity: Resources):
+        self.capacity = capacity
+        self.reserved = Resources()
+        self.running = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_docker(cls, docker: DockerSDKClient, memory: int = None, cpus: float = None) -> "ResourceBudget":
+        # configured limits take precedence over what the daemon reports
+        if memory is None or cpus is None:
+            info = docker.info()
+            memory = memory if memory is not None else info.get("MemTotal")
+            cpus = cpus if cpus is not None else info.get("NCPU")
+        capacity = Resources(memory=int(memory), cpus=float(cpus))
+        logger.info(f"Using resource budget of {capacity} for Docker daemon {docker.api.base_url}")
+        return cls(capacity=capacity)
+
+    @property
+    def available(self) -> Resources:
+        with self._lock:
+            return self.capacity - self.reserved
+
+    def can_admit(self, request: Resources) -> bool:
+        with self._lock:
+            # a request larger than the whole budget can still run, but only by itself
+            if self.running == 0:
+                return True
+            return request.fits_in(self.capacity - self.reserved)
+
+    def reserve(self, request: Resources):
+        with self._lock:
+            self.reserved = self.reserved + request
+            self.running += 1
+
+    def release(self, request: Resources):
+        with self._lock:
+            self.reserved = self.reserved - request
+            self.running -= 1
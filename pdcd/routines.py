@@ -1,18 +1,28 @@
+import concurrent.futures
+import functools
 import tempfile
 from dataclasses import dataclass, field
-from typing import List, TYPE_CHECKING
-from docker.errors import ImageNotFound
+from typing import List, Optional, Dict, Set, Tuple, TYPE_CHECKING
+from docker.types import Mount
 import pathlib
 import shlex
 import tarfile
 from enum import Enum, auto
 
 from .external import FileRegistryClient
+from .files import LocalOperations
+from .stats import ResourceUsage, StatsSampler
+from .utils import IterStream
+from .warm import WarmContainer
 from .settings import global_settings
 from .log import logger
 
 if TYPE_CHECKING:
     from .config import Config
+    from .endpoints import DockerEndpoint
+    from .cache import CacheEntry
+    from .images import ImageInfo
+    from .matrix import MatrixRoutine
 
 
 class ImageOS(Enum):
@@ -20,11 +30,76 @@ class ImageOS(Enum):
     Linux = auto()
 
 
+# bytes of other files that can be read past in an archive of a directory shared by several artifacts before
+#   the artifacts are retrieved with an archive each
+ARCHIVE_SKIP_LIMIT = 16 * 1024 * 1024
+
+
+class RoutineStatus(Enum):
+    Succeeded = auto()
+    Failed = auto()
+    Skipped = auto()  # never started because a dependency failed or the run was stopped
+    Cancelled = auto()  # container was stopped before it finished
+
+
+@dataclass
+class RoutineResult:
+    # outcome of a single routine for a run
+    name: str
+    status: RoutineStatus
+    exit_code: Optional[int] = None
+    exception: Optional[BaseException] = None
+    artifacts: List[str] = field(default_factory=list)
+    duration: Optional[float] = None
+    endpoint: Optional[str] = None
+    cached: bool = False
+    resumed: bool = False
+    usage: Optional[ResourceUsage] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == RoutineStatus.Succeeded
+
+
 @dataclass
 class RoutineArg:
     key: str
 
 
+def parse_cpuset(cpuset: str) -> List[int]:
+    """CPUs in a Docker cpuset (e.g. 0-3,6)"""
+    cpus = []
+    try:
+        for part in cpuset.split(","):
+            first, _, last = part.strip().partition("-")
+            cpus.extend(range(int(first), int(last if last != "" else first) + 1))
+    except ValueError:
+        raise Exception(f"Invalid cpuset {cpuset}")
+    return cpus
+
+
+def cli_tokens(cli: str) -> List[Tuple[str, str]]:
+    """connector name and arguments of each connector token (e.g. '@foo::bar-baz') in a CLI"""
+    tokens = []
+    for token in shlex.split(cli):
+        # nested command lines (e.g. bash -c "<cli>") are split again, same as when resolving
+        for t in shlex.split(token) if " " in token else [token]:
+            if t.startswith("@") and "::" in t:
+                connector_name, args = t.split("::", 1)
+                tokens.append((connector_name[1:], args))
+    return tokens
+
+
+def cli_file_names(cli: str) -> Set[str]:
+    """file names that a CLI can refer to: each argument, an option's value (--foo=bar) and their base names"""
+    names = set()
+    for token in shlex.split(cli):
+        for t in shlex.split(token) if " " in token else [token]:
+            for value in [t, t.split("=", 1)[-1]]:
+                names.update([value, pathlib.PurePosixPath(value).name, pathlib.PureWindowsPath(value).name])
+    return names
+
+
 @dataclass
 class Routine:
     # class that config-provided payloads get instantiated to
@@ -35,17 +110,67 @@ class Routine:
     artifacts: List[str] = field(default_factory=list)
     dependencies: List[str] = field(default_factory=list)
     store: str = None
+    priority: int = 0
+    cache: bool = True
+    warm: bool = False
+    timeout: Optional[int] = None  # seconds; defaults to the routine_timeout setting
+    mem_limit: Optional[str] = None  # Docker format, e.g. 512m; defaults to the docker_mem_limit setting
+    cpus: Optional[float] = None
+    cpuset: Optional[str] = None  # e.g. 0-3,6
+    pids_limit: Optional[int] = None
+    # disabled when the CLI was already resolved, e.g. when resuming a run from the journal
+    resolve_tokens: bool = field(default=True, repr=False)
 
     def __hash__(self):
         return hash(self.name)
 
     def __post_init__(self):
         self._check_image()
+        if self.cpus is not None and self.cpus <= 0:
+            raise Exception(f"cpus must be greater than 0 for routine {self.name}")
+        if self.cpuset is not None:
+            parse_cpuset(self.cpuset)
 
         # list of files to cleanup
         # main use is for files created during cli token resolution
         self.cleanup_files: List[str] = []
 
+        # handle to the running container so it can be stopped from another thread
+        #   along with where it runs, which is needed once it exits
+        self._container = None
+        self._endpoint: Optional["DockerEndpoint"] = None
+        self._image: Optional["ImageInfo"] = None
+        self._image_os: Optional[ImageOS] = None
+        self._warm: Optional[WarmContainer] = None
+        self._stats: Optional[StatsSampler] = None
+        self._bind_dir: Optional[str] = None
+        self._stop_requested = False
+        self._timed_out = False
+
+        # set by the job handler when the build cache is used
+        self.cache_entry: Optional["CacheEntry"] = None
+        # set when the routine was expanded from a matrix payload
+        self.matrix: Optional["MatrixRoutine"] = None
+        # set by the job handler when the routine's artifacts are only needed by other routines and the endpoint
+        #   has a shared volume; the artifacts are then copied into the volume instead of the file directory
+        self.keep_in_volume = False
+        # set by the job handler; in remote mode, artifacts are only uploaded to the remote share when other
+        #   routines depend on them (the rest are only written to the local file directory)
+        self.share_artifacts = True
+
+        if self.resolve_tokens:
+            self.resolve_cli()
+
+        # store should happen AFTER cli token resolution to support use of
+        # @artifact + store, otherwise artifacts from @artifact wont be present
+        if self.store is not None:
+            if len(self.artifacts) != 1:
+                raise Exception("Must have exactly 1 artifact when using store")
+
+            filereg: FileRegistryClient = self.config.client_manager.get_client_by_name("files").client
+            filereg.upsert_file(name=self.store, value=self.artifacts[0], payload=self.name)
+
+    def resolve_cli(self):
         cli = []
         for token in shlex.split(self.cli):
             # if, after being split, the token still has a space it needs to be split and resolved on its own. this is primarily meant for situations with nested command lines such as bash -c "<cli>"
@@ -59,19 +184,10 @@ class Routine:
 
         self.cli = shlex.join(cli)
 
-        # store should happen AFTER cli token resolution to support use of
-        # @artifact + store, otherwise artifacts from @artifact wont be present
-        if self.store is not None:
-            if len(self.artifacts) != 1:
-                raise Exception("Must have exactly 1 artifact when using store")
-
-            filereg: FileRegistryClient = self.config.client_manager.get_client_by_name("files").client
-            filereg.upsert_file(name=self.store, value=self.artifacts[0], payload=self.name)
-
     def _convert_cli_token(self, token: str):
         # token should look like '@foo::bar-baz'
         if token.startswith("@") and "::" in token:
-            connector_name, args = token.split("::")
+            connector_name, args = token.split("::", 1)
             connector_name = connector_name[1:]  # remove starting '@'
 
             client = self.config.client_manager.get_client_by_name(connector_name)
@@ -86,90 +202,524 @@ class Routine:
             return token
 
     def _check_image(self):
-        """check that image is available to Docker client"""
-        docker = self.config.get_docker_client()
-        try:
-            docker.images.get(self.image)
-        except ImageNotFound:
+        """check that image is available to at least one Docker client (or is being pulled)"""
+        if self.config.pulls is not None and self.config.pulls.pending(self.image):
+            return
+        if not self.config.docker_pool.has_image(self.image):
             raise Exception(f'Unknown image "{self.image}"')
 
     def cleanup(self):
         for f in self.cleanup_files:
             pathlib.Path(f).unlink(missing_ok=True)
 
+    @property
+    def timeout_seconds(self) -> Optional[int]:
+        timeout = self.timeout if self.timeout is not None else global_settings.routine_timeout
+        return timeout if timeout else None
+
+    def time_out(self):
+        """stop the routine for running longer than its timeout"""
+        self._timed_out = True
+        self.stop()
+
+    def stop(self):
+        """stop the routine's container if it is running or prevent it from starting if not"""
+        self._stop_requested = True
+        # the container is cleared by finish_ctr on another thread
+        ctr = self._container
+        if ctr is not None:
+            logger.info(f"Stopping container {ctr.short_id} for routine {self.name}")
+            try:
+                ctr.stop()
+            except Exception as e:
+                logger.error(f"Could not stop container {ctr.short_id}: {e}")
+
+    @property
+    def cpu_limit(self) -> Optional[float]:
+        """most CPUs the routine's container can use"""
+        limits = []
+        if self.cpus is not None:
+            limits.append(self.cpus)
+        if self.cpuset is not None:
+            limits.append(float(len(set(parse_cpuset(self.cpuset)))))
+        return min(limits) if len(limits) > 0 else None
+
+    def warm_key(self, image: "ImageInfo") -> str:
+        # warm containers are only shared by routines with the same image and limits
+        return "/".join([image.id] + [str(v) for v in [self.mem_limit, self.cpus, self.cpuset, self.pids_limit]])
+
+    def get_image_os(self, endpoint: "DockerEndpoint") -> ImageOS:
+        return ImageOS.Windows if endpoint.image(self.image).os == "windows" else ImageOS.Linux
+
     @property
     def image_os(self) -> ImageOS:
-        docker = self.config.get_docker_client()
-        image = docker.images.get(self.image)
-        imageos = image.attrs.get("Os").lower()  # this capitalization...
-        return ImageOS.Windows if imageos == "windows" else ImageOS.Linux
+        return self.get_image_os(endpoint=self.config.docker_pool.default)
 
-    def run_ctr(self):
-        docker = self.config.get_docker_client()
+    @property
+    def input_paths(self) -> List[pathlib.Path]:
+        """files and directories (e.g. directory artifacts of dependencies) in the file directory used by the CLI"""
+        # only top-level entries are considered since the CLI refers to them by their name in the shared directory
+        names = cli_file_names(self.cli)
+        return [p for p in pathlib.Path(self.config.file_dir).iterdir() if p.name in names]
+
+    @property
+    def input_files(self) -> List[pathlib.Path]:
+        """files of the input paths, including the files in input directories"""
+        files = []
+        for path in self.input_paths:
+            files.extend([path] if path.is_file() else sorted([f for f in path.rglob("*") if f.is_file()]))
+        return files
+
+    def stage_inputs(self, ctr, bind_dir: str, endpoint: "DockerEndpoint"):
+        """copy input files into a created (not yet started) or warm container's shared directory"""
+        # files that were copied into a shared volume during the run are newer than any copy in the file directory
+        produced = endpoint.volume.produced if endpoint.volume is not None else set()
+        with tempfile.TemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode="w") as tar:
+                for input_path in self.input_paths:
+                    if input_path.name not in produced:
+                        # directories are added with their contents
+                        tar.add(input_path, arcname=input_path.name)
+            f.seek(0)
+            ctr.put_archive(bind_dir, f)
 
-        if self.image_os == ImageOS.Windows:
+    def container_args(self, endpoint: "DockerEndpoint", image_os: ImageOS) -> Tuple[str, dict]:
+        """shared directory path and container create arguments for the routine's containers on an endpoint"""
+        mem_limit = self.mem_limit if self.mem_limit is not None else global_settings.docker_mem_limit
+        limit_args = {}
+        if self.cpus is not None:
+            limit_args["nano_cpus"] = int(self.cpus * 1e9)
+
+        if image_os == ImageOS.Windows:
             bind_dir = "c:/shared"
             network = "nat"  # https://techcommunity.microsoft.com/t5/itops-talk-blog/docker-host-network-alternatives-for-windows-containers/ba-p/3390115
             memswap = None  # Docker on Windows does not support swap
+            if self.cpuset is not None or self.pids_limit is not None:
+                logger.warning(f"cpuset and pids_limit are not supported for Windows routine {self.name}")
         else:
             bind_dir = "/shared"
             network = "host"
-            memswap = global_settings.docker_memswap_limit
+            # a payload's memory limit does not allow swap, same as the default limits
+            memswap = self.mem_limit if self.mem_limit is not None else global_settings.docker_memswap_limit
+            if self.cpuset is not None:
+                limit_args["cpuset_cpus"] = self.cpuset
+            if self.pids_limit is not None:
+                limit_args["pids_limit"] = self.pids_limit
 
-        labels = {"pdcd": "true"}  # values need to stay as strings
+        labels = {"pdcd": "true", "pdcd.image": self.image}  # values need to stay as strings
         if self.config.remote_build:
             # when running remote, tag container with aws caller arn
             #   this should include the users email as the role session name
             #   and it can be used for filtering results when retrieving logs
             labels["aws_arn"] = self.config.remote_client.fwd_params.aws_arn
 
-        ctr = docker.containers.run(
-            image=self.image,
+        if endpoint.volume is not None:
+            mount_args = {"mounts": [Mount(target=bind_dir, source=endpoint.volume.name, type="volume")]}
+        elif endpoint.stages_inputs:
+            # an anonymous volume is used so the input files can be copied in before the container starts
+            #   it is removed along with the container
+            mount_args = {"mounts": [Mount(target=bind_dir, source="", type="volume")]}
+        else:
+            mount_args = {"volumes": {endpoint.mnt_dir: {"bind": bind_dir, "mode": "rw"}}}
+
+        return bind_dir, dict(
             auto_remove=False,
-            remove=False,
             network_mode=network,
-            command=self.cli,
-            volumes={self.config.mnt_dir: {"bind": bind_dir, "mode": "rw"}},
-            detach=True,
-            mem_limit=global_settings.docker_mem_limit,
+            mem_limit=mem_limit,
             memswap_limit=memswap,
             # oom_kill_disable=True,
             labels=labels,
             # golang specific soft resource limit for golang >= v1.19
             # environment={"GOMEMLIMIT":"1GiB"}
+            **limit_args,
+            **mount_args,
         )
-        ctr.wait()
-        ctr_dir = ctr.attrs["Config"]["WorkingDir"]
-        for artifact in self.artifacts:
-            ctr_artifact = artifact
-            if self.image_os == ImageOS.Windows:
-                # normal pathlib paths do not handle windows drive letters so need to use purewindowspath instead
-                artifact_o = pathlib.PureWindowsPath(artifact)
-            else:
-                artifact_o = pathlib.Path(artifact)
-                if not artifact.startswith("/"):
-                    ctr_artifact = f"{ctr_dir}/{artifact}"
 
+    def exec_command(self, image: "ImageInfo") -> List[str]:
+        """command for running the routine in an already started container of its image"""
+        # a container's command is appended to the image's entrypoint, so the same is done for exec
+        return list(image.entrypoint) + (shlex.split(self.cli) if self.cli != "" else list(image.cmd))
+
+    def create_warm_container(self, endpoint: "DockerEndpoint", image: "ImageInfo") -> WarmContainer:
+        bind_dir, container_args = self.container_args(endpoint=endpoint, image_os=ImageOS.Linux)
+        container_args["labels"]["pdcd.warm"] = "true"
+        # the container only needs to stay up; routines are run in it with exec
+        ctr = endpoint.docker.containers.create(
+            image=image.id, entrypoint=["sleep", "infinity"], command=[], **container_args
+        )
+        try:
+            ctr.start()
+        except Exception as e:
+            ctr.remove(v=True, force=True)
+            raise e
+        return WarmContainer(ctr=ctr, bind_dir=bind_dir)
+
+    def start_exec(
+        self, endpoint: "DockerEndpoint", image: "ImageInfo", warm: WarmContainer
+    ) -> concurrent.futures.Future:
+        """run the routine's CLI in a warm container"""
+        docker = endpoint.docker
+        self._container = warm.ctr
+        self._warm = warm
+        self._bind_dir = warm.bind_dir
+        try:
+            if endpoint.stages_inputs:
+                self.stage_inputs(ctr=warm.ctr, bind_dir=warm.bind_dir, endpoint=endpoint)
+            exec_id = docker.api.exec_create(
+                warm.ctr.id, cmd=self.exec_command(image), workdir=image.working_dir or None
+            )["Id"]
+            exit_future = endpoint.watcher.expect(exec_id, is_exec=True)
             try:
-                tarstream, stats = ctr.get_archive(ctr_artifact)
+                if self.config.output is not None:
+                    # the exec is started attached so its output can be streamed; the exit is still an event
+                    self.config.output.attach(name=self.name, sock=docker.api.exec_start(exec_id, socket=True))
+                else:
+                    docker.api.exec_start(exec_id, detach=True)
             except Exception as e:
-                logger.error(f"Unknown artifact {ctr_artifact} in container {ctr.short_id}")
+                endpoint.watcher.forget(exec_id)
                 raise e
-            tarf = tempfile.mkstemp(suffix=".tar")[1]
-            tarf_o = pathlib.Path(tarf)
-            with tarf_o.open("wb") as f:
-                for chunk in tarstream:
-                    f.write(chunk)
-            tar = tarfile.open(tarf)
-            artifact_member = tar.extractfile(tar.getmember(artifact_o.name))
-            tarf_o.unlink()
+        except Exception as e:
+            endpoint.warm.release(image_id=self.warm_key(image), warm=warm, reuse=False)
+            self._container = None
+            self._warm = None
+            raise e
+
+        logger.info(f"Running routine {self.name} in warm container {warm.ctr.short_id} (exec {exec_id[:12]})")
+        return exit_future
+
+    def start_ctr(self, endpoint: "DockerEndpoint" = None, watch: bool = False) -> Optional[concurrent.futures.Future]:
+        """
+        create and start the routine's container
+
+        :param endpoint: Docker endpoint to run on; defaults to the default Docker client
+        :param watch: register the container with the endpoint's event watcher before starting it
+        :return: future for the container exit code when watching or when run in a warm container
+        """
+        endpoint = endpoint if endpoint is not None else self.config.docker_pool.default
+        docker = endpoint.docker
+        # the container is created from the image ID that the tag resolved to at the start of the run
+        image = endpoint.image(self.image)
+        image_os = self.get_image_os(endpoint=endpoint)
+        self._endpoint = endpoint
+        self._image = image
+        self._image_os = image_os
+
+        if self.config.remote_build and not endpoint.stages_inputs and endpoint.mnt_dir == self.config.mnt_dir:
+            # inputs that were not uploaded with the rest of the run (e.g. token files of matrix routines)
+            self.config.file_manager.upload_changed(self.input_files)
+
+        if endpoint.volume is not None:
+            if endpoint.volume.tmpfs and image_os == ImageOS.Windows:
+                raise Exception("tmpfs shared volumes are not supported for Windows images")
+            endpoint.volume.ensure(image_id=image.id)
+
+        # warm containers only keep running with a Linux sleep command
+        if self.warm and image_os == ImageOS.Linux and len(self.exec_command(image)) > 0:
+            create = functools.partial(self.create_warm_container, endpoint=endpoint, image=image)
+            try:
+                warm = endpoint.warm.acquire(image_id=self.warm_key(image), create=create)
+            except Exception as e:
+                # e.g. images without a sleep command; the routine falls back to its own container as when all
+                #   warm containers are in use
+                logger.warning(f"Could not start a warm container for routine {self.name}: {e}")
+                warm = None
+            if warm is not None:
+                exit_future = self.start_exec(endpoint=endpoint, image=image, warm=warm)
+                if self._stop_requested:
+                    self.stop()
+                return exit_future
+
+        bind_dir, container_args = self.container_args(endpoint=endpoint, image_os=image_os)
+        ctr = docker.containers.create(image=image.id, command=self.cli, **container_args)
+        self._container = ctr
+        self._bind_dir = bind_dir
+
+        exit_future = None
+        try:
+            if endpoint.stages_inputs:
+                self.stage_inputs(ctr=ctr, bind_dir=bind_dir, endpoint=endpoint)
+            if self.config.output is not None:
+                self.stream_output(endpoint=endpoint, ctr=ctr)
+            if watch:
+                exit_future = endpoint.watcher.expect(ctr.id)
+            ctr.start()
+        except Exception as e:
+            if watch:
+                endpoint.watcher.forget(ctr.id)
+            if self.config.cleanup:
+                ctr.remove(v=True)
+            self._container = None
+            raise e
+
+        # warm containers are shared by routines so their stats are not sampled
+        if global_settings.container_stats:
+            self._stats = StatsSampler.start(docker=docker, ctr=ctr)
+        if self._stop_requested:
+            self.stop()
+        return exit_future
+
+    def stream_output(self, endpoint: "DockerEndpoint", ctr):
+        # attached before the container is started so no output is missed
+        # a routine is still run if its output cannot be streamed
+        try:
+            sock = endpoint.docker.api.attach_socket(ctr.id, params={"stdout": 1, "stderr": 1, "stream": 1, "logs": 1})
+            self.config.output.attach(name=self.name, sock=sock)
+        except Exception as e:
+            logger.error(f"Could not stream output of container {ctr.short_id} for routine {self.name}: {e}")
+
+    def finish_ctr(self, exit_code: int) -> RoutineResult:
+        """record the result of the routine's exited container and extract its artifacts"""
+        ctr = self._container
+        self._container = None
+
+        result = RoutineResult(
+            name=self.name, status=RoutineStatus.Succeeded, exit_code=exit_code, endpoint=self._endpoint.name
+        )
+        if self._stats is not None:
+            result.usage = self._stats.stop(oom_killed=self.was_oom_killed(ctr))
+            self._stats = None
+
+        if self._timed_out:
+            result.status = RoutineStatus.Failed
+            result.exception = Exception(f"timed out after {self.timeout_seconds}s")
+            self.log_container_output(ctr)
+        elif self._stop_requested:
+            result.status = RoutineStatus.Cancelled
+        elif result.usage is not None and result.usage.oom_killed:
+            logger.error(f"Container {ctr.short_id} for routine {self.name} ran out of memory")
+            result.status = RoutineStatus.Failed
+            mem_limit = self.mem_limit if self.mem_limit is not None else global_settings.docker_mem_limit
+            result.exception = Exception(f"killed by the OOM killer (mem_limit {mem_limit})")
+        elif exit_code != 0:
+            logger.error(f"Container {ctr.short_id} for routine {self.name} exited with status {exit_code}")
+            result.status = RoutineStatus.Failed
+
+        try:
+            # a failed container is unlikely to have produced its artifacts so extraction is only attempted
+            #   on success
+            if result.succeeded and self.keep_in_volume:
+                self.copy_to_volume(ctr=ctr, result=result)
+            elif result.succeeded:
+                self.extract_artifacts(ctr=ctr, result=result, image_os=self._image_os)
+        finally:
+            if self._warm is not None:
+                # a warm container is only reused when the routine in it succeeded
+                self._endpoint.warm.release(
+                    image_id=self.warm_key(self._image), warm=self._warm, reuse=result.succeeded
+                )
+                self._warm = None
+            elif self.config.cleanup:
+                ctr.remove(v=True)
+
+        return result
 
-            # pathlib.Path(f"{self.config.file_dir}/{artifact_o.name}").write_bytes(artifact_member.read())
-            self.config.file_manager.write(content=artifact_member.read(), filename=artifact_o.name)
+    @staticmethod
+    def was_oom_killed(ctr) -> bool:
+        try:
+            ctr.reload()
+        except Exception as e:
+            logger.error(f"Could not inspect container {ctr.short_id}: {e}")
+            return False
+        return bool(ctr.attrs.get("State", {}).get("OOMKilled", False))
+
+    def log_container_output(self, ctr, tail: int = 100):
+        # streamed output is already in the routine's log file
+        if self.config.output is not None:
+            logger.error(f"Output of routine {self.name} is in {self.config.output.logfile(self.name).as_posix()}")
+            return
+        # commands run in warm containers are detached so their output is not kept
+        if self._warm is not None:
+            return
+        try:
+            output = ctr.logs(tail=tail).decode(errors="replace")
+        except Exception as e:
+            logger.error(f"Could not get logs of container {ctr.short_id}: {e}")
+            return
+        logger.error(f"Last {tail} lines of output of container {ctr.short_id} for routine {self.name}:\n{output}")
+
+    def run_ctr(self, endpoint: "DockerEndpoint" = None) -> RoutineResult:
+        """run the routine's container to completion in the current thread"""
+        exit_future = self.start_ctr(endpoint=endpoint)
+        if exit_future is not None:
+            # commands in warm containers are always watched
+            exit_code = exit_future.result()
+        else:
+            exit_code = self._container.wait().get("StatusCode")
+        return self.finish_ctr(exit_code=exit_code)
+
+    def artifact_path(self, artifact: str, ctr_dir: str, image_os: ImageOS) -> pathlib.PurePath:
+        if image_os == ImageOS.Windows:
+            # normal pathlib paths do not handle windows drive letters so need to use purewindowspath instead
+            return pathlib.PureWindowsPath(artifact)
+        if not artifact.startswith("/"):
+            artifact = f"{ctr_dir}/{artifact}"
+        return pathlib.PurePosixPath(artifact)
+
+    def copy_to_volume(self, ctr, result: RoutineResult):
+        """copy the artifacts into the shared volume (through the Docker API) instead of the file directory"""
+        ctr_dir = self._image.working_dir if self._image is not None else ctr.attrs["Config"]["WorkingDir"]
+        for artifact in self.artifacts:
+            artifact_o = self.artifact_path(artifact, ctr_dir=ctr_dir, image_os=self._image_os)
+            if artifact_o.parent.as_posix().rstrip("/") != self._bind_dir:
+                try:
+                    tarstream, stats = ctr.get_archive(artifact_o.as_posix())
+                except Exception as e:
+                    logger.error(f"Unknown artifact {artifact_o.as_posix()} in container {ctr.short_id}")
+                    raise e
+                # the archive is streamed back into the container's shared directory, which is the volume
+                ctr.put_archive(self._bind_dir, tarstream)
+            self._endpoint.volume.produced.add(artifact_o.name)
+            result.artifacts.append(artifact_o.name)
+
+    def extract_artifacts(self, ctr, result: RoutineResult, image_os: ImageOS):
+        ctr_dir = self._image.working_dir if self._image is not None else ctr.attrs["Config"]["WorkingDir"]
+
+        # artifacts in the same directory are retrieved with a single archive of that directory
+        groups: Dict[str, List[str]] = {}  # container directory -> artifact names
+        for artifact in self.artifacts:
+            artifact_o = self.artifact_path(artifact, ctr_dir=ctr_dir, image_os=image_os)
+            groups.setdefault(artifact_o.parent.as_posix(), []).append(artifact_o.name)
+
+        for directory, names in groups.items():
+            if directory.rstrip("/") == self._bind_dir and self.writes_file_dir:
+                # the container wrote these artifacts to the file directory itself; copying them out would
+                #   truncate the files while the daemon is still reading them for the archive
+                for name in names:
+                    self.record_file_dir_artifact(name=name, result=result)
+            else:
+                # an archive of the root directory would be the entire filesystem, and one of the shared directory
+                #   would contain every input and output of the run
+                remaining = names
+                if len(names) > 1 and not (
+                    directory in ["/", "."] or directory.endswith(":/") or directory.rstrip("/") == self._bind_dir
+                ):
+                    remaining = self.stream_artifacts(
+                        ctr=ctr, ctr_path=directory, names=names, result=result, strip=1, skip_limit=ARCHIVE_SKIP_LIMIT
+                    )
+                # in remote mode, artifacts in the shared directory are already on the remote share
+                on_share = directory.rstrip("/") == self._bind_dir and self.writes_share
+                for name in remaining:
+                    ctr_path = name if directory == "." else f"{directory.rstrip('/')}/{name}"
+                    self.stream_artifacts(ctr=ctr, ctr_path=ctr_path, names=[name], result=result, on_share=on_share)
+
+    @property
+    def writes_file_dir(self) -> bool:
+        """whether the routine's shared directory is the file directory bind mounted from this host"""
+        return (
+            self._endpoint is not None
+            and not self._endpoint.stages_inputs
+            and self._endpoint.mnt_dir == self.config.file_dir
+        )
+
+    @property
+    def writes_share(self) -> bool:
+        """whether the routine's shared directory is the run's directory on the remote share"""
+        return (
+            self.config.remote_build
+            and self._endpoint is not None
+            and not self._endpoint.stages_inputs
+            and self._endpoint.mnt_dir == self.config.mnt_dir
+        )
+
+    def record_file_dir_artifact(self, name: str, result: RoutineResult):
+        """add an artifact that is already in the file directory (a file or the files of a directory)"""
+        file_dir = pathlib.Path(self.config.file_dir)
+        path = file_dir / name
+        if not path.exists():
+            logger.error(f"Unknown artifact {name} in {self._bind_dir}")
+            raise Exception(f"Unknown artifact(s) {name}")
+        files = [path] if path.is_file() else sorted([f for f in path.rglob("*") if f.is_file()])
+        for f in files:
+            filename = f.relative_to(file_dir).as_posix()
+            if self.cache_entry is not None:
+                self.cache_entry.add(name=filename, source=f)
+            result.artifacts.append(filename)
+
+    def stream_artifacts(
+        self,
+        ctr,
+        ctr_path: str,
+        names: List[str],
+        result: RoutineResult,
+        strip: int = 0,
+        skip_limit: Optional[int] = None,
+        on_share: bool = False,
+    ) -> List[str]:
+        """
+        write the artifacts in a container archive to the file directory as the archive is received
+
+        :param ctr: container
+        :param ctr_path: path in the container to retrieve
+        :param names: artifact names (files or directories) to keep from the archive
+        :param result: result to add the written artifacts to
+        :param strip: number of leading path components to remove from archive members
+        :param skip_limit: stop reading the archive once more than this many bytes of other files were skipped
+        :param on_share: the artifacts are in the shared directory on the remote share
+        :return: names that were not retrieved because the archive was stopped
+        """
+        try:
+            tarstream, stats = ctr.get_archive(ctr_path)
+        except Exception as e:
+            logger.error(f"Unknown artifact {ctr_path} in container {ctr.short_id}")
+            raise e
+
+        found = set()
+        skipped = 0
+        # "r|" reads the archive sequentially so only the member being written is held in memory
+        #   other members in the directory are read past without being written
+        # the stat header of a directory does not include the size of its contents, so a large directory is
+        #   only noticed by the amount of skipped data
+        with tarfile.open(fileobj=IterStream(tarstream), mode="r|") as tar:
+            for member in tar:
+                parts = pathlib.PurePosixPath(member.name).parts[strip:]
+                if len(parts) == 0 or parts[0] not in names:
+                    skipped += member.size
+                    if skip_limit is not None and skipped > skip_limit:
+                        remaining = [name for name in names if name not in found]
+                        logger.info(f"Retrieving artifacts in {ctr_path} of container {ctr.short_id} separately")
+                        tarstream.close()
+                        return remaining
+                    continue
+                found.add(parts[0])
+                if not member.isfile():
+                    continue
+                # files in directory artifacts keep their path relative to the artifact's parent directory
+                filename = "/".join(parts)
+                self.write_artifact(fileobj=tar.extractfile(member), filename=filename, on_share=on_share)
+                if self.cache_entry is not None:
+                    self.cache_entry.add(name=filename, source=pathlib.Path(self.config.file_dir) / filename)
+                result.artifacts.append(filename)
+
+        if (missing := set(names) - found) != set():
+            logger.error(f"Unknown artifact(s) {', '.join(missing)} in {ctr_path} in container {ctr.short_id}")
+            raise Exception(f"Unknown artifact(s) {', '.join(missing)}")
+        return []
+
+    def write_artifact(self, fileobj, filename: str, on_share: bool = False):
+        if self.config.remote_build:
+            # artifacts are written to the local file directory as soon as the routine finishes
+            # artifacts that the container wrote to the share are recorded as copies so they are not uploaded or
+            #   downloaded again; others are uploaded only when routines on the remote host depend on them (other
+            #   inputs, e.g. files of finished routines used through @files tokens, are uploaded when a routine
+            #   starts)
+            local_path = pathlib.Path(self.config.file_dir) / filename
+            LocalOperations.write_stream(fileobj, local_path.as_posix())
+            if on_share:
+                self.config.file_manager.record_local_copy(local_path.as_posix(), name=filename)
+            elif self.share_artifacts:
+                self.config.file_manager.upload(local_path.as_posix(), name=filename)
+        else:
+            self.config.file_manager.write_stream(fileobj=fileobj, filename=filename)
 
-        if self.config.cleanup:
-            ctr.remove()
+    def restore_from_cache(self) -> RoutineResult:
+        """write the artifacts of a previous identical run instead of running the container"""
+        result = RoutineResult(name=self.name, status=RoutineStatus.Succeeded, cached=True)
+        for artifact in self.cache_entry.artifacts:
+            with self.cache_entry.open(artifact) as f:
+                self.write_artifact(fileobj=f, filename=artifact)
+            result.artifacts.append(artifact)
+        return result
 
     @classmethod
-    def run(cls, *constructor_args, **constructor_kwargs):
-        cls(*constructor_args, **constructor_kwargs).run_ctr()
+    def run(cls, *constructor_args, **constructor_kwargs) -> RoutineResult:
+        return cls(*constructor_args, **constructor_kwargs).run_ctr()
@@ -0,0 +1,148 @@
+import concurrent.futures
+import pathlib
+from functools import partial
+from typing import List, Union
+
+from .config import Config, PayloadConfig
+from .routines import Routine, cli_tokens
+from .matrix import MatrixRoutine, payload_images
+from .jobs import JobHandler
+from .history import RoutineHistory
+from .cache import BuildCache
+from .journal import JOURNAL_NAME, RunJournal, payload_hash
+from .output import OutputStreamer
+from .pulls import ImagePuller
+from .settings import global_settings
+from .log import logger
+
+
+def prefetch_tokens(config: Config, payloads: List[PayloadConfig]):
+    # the expensive part of token resolution (exporting shellcode) is done for all unique tokens at once so that
+    #   exports from different servers run at the same time; the payloads are then resolved in order using
+    #   the cached exports
+    # matrix tokens that contain placeholders are only known once the matrix is expanded
+    tokens = set()
+    for payload in payloads:
+        for connector_name, args in cli_tokens(payload.cli):
+            if payload.matrix is None or "{" not in args:
+                tokens.add((connector_name, args))
+    if len(tokens) == 0:
+        return
+
+    logger.info(f"Prefetching {len(tokens)} unique CLI tokens")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=global_settings.token_workers) as executor:
+        futures = [
+            executor.submit(config.client_manager.get_client_by_name(connector_name).client.prefetch_token, args)
+            for connector_name, args in sorted(tokens)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def init_routine(config: Config, journal: RunJournal, payload: PayloadConfig) -> Routine:
+    digest = payload_hash(payload)
+    if (resolved := journal.resolved_for(payload, digest)) is not None:
+        # token files from the interrupted run are reused rather than exported again
+        routine = Routine(
+            **{**payload.routine_args, **{k: resolved[k] for k in ["cli", "artifacts", "dependencies"]}},
+            config=config,
+            resolve_tokens=False,
+        )
+        routine.cleanup_files = resolved["cleanup_files"]
+    else:
+        routine = Routine(**payload.routine_args, config=config)
+    journal.record_resolved(digest, routine)
+    return routine
+
+
+def init_routines(config: Config, journal: RunJournal) -> List[Union[Routine, MatrixRoutine]]:
+    # init'ing the routines will cause the token resolution (therefore downloading shellcode) so its done first
+    # the exception is matrix payloads, whose routines are created by the job handler when they are about to run
+    #   these are set up last so that files stored by any other payload are known
+    # payloads that are reused from the journal do not need their tokens resolved
+    unresolved = [p for p in config.payloads if journal.resolved_for(p, payload_hash(p)) is None]
+    prefetch_tokens(config=config, payloads=unresolved)
+    routines = [None] * len(config.payloads)
+    for index, payload in enumerate(config.payloads):
+        if payload.matrix is None:
+            routines[index] = init_routine(config=config, journal=journal, payload=payload)
+    for index, payload in enumerate(config.payloads):
+        if payload.matrix is not None:
+            factory = partial(init_routine, config, journal)
+            routines[index] = MatrixRoutine(payload=payload, config=config, factory=factory)
+    return routines
+
+
+def input_files(routines: List[Union[Routine, MatrixRoutine]]) -> List[pathlib.Path]:
+    """files in the file directory referenced by the routines; matrix routines upload their own when they start"""
+    files = {}
+    for routine in routines:
+        if isinstance(routine, Routine):
+            files.update({f.as_posix(): f for f in routine.input_files if f.name != JOURNAL_NAME})
+    return [files[name] for name in sorted(files)]
+
+
+def run_config(
+    config: Config,
+    fail_fast: bool = False,
+    stop_running: bool = False,
+    resume: bool = False,
+    use_cache: bool = None,
+    stop_clients: bool = True,
+    console_output: bool = True,
+) -> JobHandler:
+    """
+    execute all payloads in a config
+
+    :param config: config to run
+    :param fail_fast: do not start new jobs after the first failure
+    :param stop_running: with fail_fast, also stop running containers after the first failure
+    :param resume: resume an interrupted run from the journal in the file directory
+    :param use_cache: use the build cache; defaults to the build_cache setting
+    :param stop_clients: stop long-lived client resources (e.g. port forwards) after the run
+    :param console_output: print container output to the console as it is streamed
+    :return: job handler with the results of the run
+    """
+    try:
+        # pulls run in the background while tokens are resolved and jobs whose images are available run
+        if global_settings.pull_images or global_settings.image_registry is not None:
+            images = [image for payload in config.payloads for image in payload_images(payload)]
+            config.pulls = ImagePuller.start(pool=config.docker_pool, images=images)
+
+        journal = RunJournal(file_dir=config.file_dir, resume=resume)
+        routines = init_routines(config=config, journal=journal)
+
+        # after generation, push the files the routines use to the share
+        if config.remote_build:
+            config.file_manager.sync_local_to_remote(files=input_files(routines))
+
+        # run all jobs
+        if global_settings.stream_output:
+            config.output = OutputStreamer(directory=global_settings.output_dir, console=console_output)
+        history = RoutineHistory(path=global_settings.history_file)
+        if use_cache is None:
+            use_cache = global_settings.build_cache
+        cache = BuildCache(directory=global_settings.cache_dir) if use_cache else None
+        jobhandler = JobHandler(
+            routines=routines,
+            workers=config.workers,
+            history=history,
+            fail_fast=fail_fast,
+            stop_running=stop_running,
+            pool=config.docker_pool,
+            cache=cache,
+            journal=journal,
+            pulls=config.pulls,
+        )
+        jobhandler.run()
+
+        # pull down all remote files after completion
+        if config.remote_build:
+            config.file_manager.sync_remote_to_local()
+
+        # token files are only removed after a run that was not interrupted so they can be reused on resume
+        jobhandler.cleanup_routines()
+    finally:
+        config.cleanup_resources(stop_clients=stop_clients)
+
+    return jobhandler
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from pathlib import Path
+from typing import Optional
 import os
 
 from .utils import get_user_pdcd_cfg_dir, find_free_local_port
@@ -21,10 +22,40 @@ class GlobalSettings(BaseSettings):
     # general settings
     log_file: str = Field(default=".pdcd.log", env="PDCD_LOGFILE")
     connectors_file: Path = Field(default_factory=lambda: cfg_file("connectors"), env="PDCD_CONNECTORS")
+    history_file: Path = Field(default_factory=lambda: cfg_file("history.json"), env="PDCD_HISTORY")
+    cache_dir: Path = Field(default_factory=lambda: cfg_file("cache"), env="PDCD_CACHE_DIR")
+    build_cache: bool = Field(default=False, env="PDCD_BUILD_CACHE")
+    token_workers: int = Field(default=4, env="PDCD_TOKEN_WORKERS")
+    # container output is streamed to a log file per routine in output_dir while it runs
+    stream_output: bool = Field(default=True, env="PDCD_STREAM_OUTPUT")
+    output_dir: Path = Field(default=Path(".pdcd-output"), env="PDCD_OUTPUT_DIR")
 
     # docker settings
     docker_mem_limit: str = Field(default="2G", env="PDCD_DOCKER_MEM_LIMIT")
     docker_memswap_limit: str = Field(default="2G", env="PDCD_DOCKER_MEMSWAP_LIMIT")
+    # images missing from the Docker endpoints are pulled at the start of a run when a registry is configured
+    #   (or, with pull_images, from Docker Hub); tool images are usually local-only so pulling is opt-in
+    pull_images: bool = Field(default=False, env="PDCD_PULL_IMAGES")
+    image_registry: Optional[str] = Field(default=None, env="PDCD_IMAGE_REGISTRY")
+    pull_workers: int = Field(default=4, env="PDCD_PULL_WORKERS")
+    # size of the shared directory for configs with shared_volume: tmpfs
+    shared_tmpfs_size: Optional[str] = Field(default="1g", env="PDCD_SHARED_TMPFS_SIZE")
+    # small Linux image (with sleep) for the container that holds a tmpfs shared directory
+    shared_volume_image: Optional[str] = Field(default="busybox:1.36.1", env="PDCD_SHARED_VOLUME_IMAGE")
+    # sample memory/CPU/IO of containers from the stats API while they run
+    container_stats: bool = Field(default=True, env="PDCD_CONTAINER_STATS")
+    # seconds a job can run before its container is stopped; 0 for no limit
+    routine_timeout: int = Field(default=0, env="PDCD_ROUTINE_TIMEOUT")
+
+    # scheduler settings
+    # when unset, the budget comes from the memory/CPUs reported by the Docker daemon
+    scheduler_mem_budget: Optional[str] = Field(default=None, env="PDCD_SCHEDULER_MEM")
+    scheduler_cpu_budget: Optional[float] = Field(default=None, env="PDCD_SCHEDULER_CPUS")
+    # threads used to start containers and handle exited containers (e.g. artifact extraction)
+    scheduler_io_workers: int = Field(default=4, env="PDCD_SCHEDULER_IO_WORKERS")
+    # warm containers (payloads with warm: true)
+    warm_pool_size: int = Field(default=2, env="PDCD_WARM_POOL_SIZE")
+    warm_container_uses: int = Field(default=20, env="PDCD_WARM_CONTAINER_USES")
 
     # mythic connector settings
     mythic_callback_interval: int = Field(default=15, env="PDCD_MYTHIC_INTERVAL")
@@ -44,6 +75,17 @@ class GlobalSettings(BaseSettings):
     smb_target_port: int = Field(default=445, env="PDCD_SMB_TARGET")
     smb_bind_port: int = Field(default_factory=find_free_local_port, env="PDCD_SMB_BIND")
     shell_logging: bool = Field(default=True, env="PDCD_SHELL_LOGGING")
+    port_forward_timeout: int = Field(default=30, env="PDCD_FORWARD_TIMEOUT")
+    # logged-in SMB sessions kept open for reuse
+    smb_sessions: int = Field(default=8, env="PDCD_SMB_SESSIONS")
+    # SMB transfers are read/written in chunks; files of at least the threshold are split into ranges that are
+    #   transferred in parallel (sizes in bytes)
+    smb_chunk_size: int = Field(default=4 * 1024 * 1024, env="PDCD_SMB_CHUNK_SIZE")
+    smb_parallel_threshold: int = Field(default=64 * 1024 * 1024, env="PDCD_SMB_PARALLEL_THRESHOLD")
+    smb_transfer_workers: int = Field(default=4, env="PDCD_SMB_TRANSFER_WORKERS")
+
+    # daemon settings
+    daemon_socket: Path = Field(default_factory=lambda: cfg_file("pdcd.sock"), env="PDCD_DAEMON_SOCKET")
 
 
 global_settings = GlobalSettings()
@@ -0,0 +1,118 @@
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from docker.utils import version_gte
+
+from .log import logger
+
+# seconds between samples of a running container
+SAMPLE_INTERVAL = 2
+# seconds to wait for a sample in progress after the container exited
+STOP_TIMEOUT = 2
+
+
+def format_bytes(value: int) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if value < 1024:
+            return f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}GiB"
+
+
+@dataclass
+class ResourceUsage:
+    # resources used by a routine's container, sampled from the Docker stats API while it ran
+    peak_memory: Optional[int] = None  # bytes, excluding the page cache
+    cpu_seconds: Optional[float] = None
+    block_read: int = 0  # bytes
+    block_write: int = 0  # bytes
+    oom_killed: bool = False
+
+    def cpus(self, duration: float) -> Optional[float]:
+        """average number of CPUs used over the routine's duration"""
+        if self.cpu_seconds is None or duration is None or duration <= 0:
+            return None
+        return self.cpu_seconds / duration
+
+    def __str__(self):
+        parts = []
+        if self.peak_memory is not None:
+            parts.append(f"peak memory {format_bytes(self.peak_memory)}")
+        if self.cpu_seconds is not None:
+            parts.append(f"cpu {self.cpu_seconds:.1f}s")
+        if self.block_read > 0 or self.block_write > 0:
+            parts.append(f"io {format_bytes(self.block_read)} read/{format_bytes(self.block_write)} written")
+        if self.oom_killed:
+            parts.append("OOM killed")
+        return ", ".join(parts)
+
+
+class StatsSampler:
+    # This class samples the stats of a single running container in a background thread
+    # Samples are requested one at a time (every SAMPLE_INTERVAL seconds) rather than streamed, since the Docker
+    #   daemon keeps a stats stream open (sending empty samples) until the container is removed
+    # The peak memory is the highest sample while CPU time and block I/O are cumulative so the last sample is kept
+    # Linux and Windows containers report different fields, both are handled
+    def __init__(self, docker, ctr):
+        self._docker = docker
+        self._ctr = ctr
+        self.usage = ResourceUsage()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"pdcd-stats-{ctr.short_id}", daemon=True)
+
+    @classmethod
+    def start(cls, docker, ctr) -> "StatsSampler":
+        sampler = cls(docker=docker, ctr=ctr)
+        sampler._thread.start()
+        return sampler
+
+    def _run(self):
+        # without one-shot, the daemon waits for a second sample to compute the CPU percentage, which is not used
+        one_shot = True if version_gte(self._docker.api.api_version, "1.41") else None
+        while not self._stopped.is_set():
+            try:
+                sample = self._docker.api.stats(self._ctr.id, stream=False, one_shot=one_shot)
+            except Exception as e:
+                # the container can be removed between samples
+                if not self._stopped.is_set():
+                    logger.warning(f"Stats of container {self._ctr.short_id} unavailable: {e}")
+                return
+            self.add_sample(sample)
+            self._stopped.wait(SAMPLE_INTERVAL)
+
+    def add_sample(self, sample: dict):
+        memory_stats = sample.get("memory_stats") or {}
+        cpu_stats = sample.get("cpu_stats") or {}
+        if len(memory_stats) == 0 and len(cpu_stats) == 0:
+            # stats of a stopped container are empty
+            return
+
+        usage = self.usage
+        if "privateworkingset" in memory_stats:
+            # windows; cpu usage is in 100ns intervals
+            memory = memory_stats["privateworkingset"]
+            cpu_seconds = cpu_stats.get("cpu_usage", {}).get("total_usage", 0) / 1e7
+            storage_stats = sample.get("storage_stats") or {}
+            usage.block_read = storage_stats.get("read_size_bytes", usage.block_read)
+            usage.block_write = storage_stats.get("write_size_bytes", usage.block_write)
+        else:
+            # linux; the page cache is not counted, same as docker stats (cgroup v1 and v2 use different names)
+            page_stats = memory_stats.get("stats") or {}
+            cache = page_stats.get("total_inactive_file", page_stats.get("inactive_file", 0))
+            memory = max(memory_stats.get("usage", 0) - cache, 0)
+            cpu_seconds = cpu_stats.get("cpu_usage", {}).get("total_usage", 0) / 1e9
+            io_stats = (sample.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+            if len(io_stats) > 0:
+                usage.block_read = sum([s["value"] for s in io_stats if s.get("op", "").lower() == "read"])
+                usage.block_write = sum([s["value"] for s in io_stats if s.get("op", "").lower() == "write"])
+
+        usage.peak_memory = max(memory, usage.peak_memory or 0)
+        usage.cpu_seconds = max(cpu_seconds, usage.cpu_seconds or 0.0)
+
+    def stop(self, oom_killed: bool = False) -> ResourceUsage:
+        """stop sampling once the container exited and return the usage"""
+        self._stopped.set()
+        # only a sample that is in progress is waited for
+        self._thread.join(timeout=STOP_TIMEOUT)
+        self.usage.oom_killed = oom_killed
+        return self.usage
@@ -0,0 +1,69 @@
+import pathlib
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from .cache import hash_file
+
+
+@dataclass
+class ManifestEntry:
+    size: int
+    mtime: Optional[float] = None
+    digest: Optional[str] = None
+
+
+class SyncManifest:
+    # This class records what was copied between the file directory and the remote share during a run so that
+    #   files are only uploaded when they changed and only new files are downloaded at the end of the run
+    # Local entries are the size, mtime and hash of a file when it was uploaded. A file with the same size and
+    #   mtime is unchanged; one that was only touched (same size, new mtime) is hashed to tell
+    # Remote entries are the size of the uploaded file on the share, plus its mtime once the share was listed,
+    #   so a file that a container changed on the share is downloaded again
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local: Dict[str, ManifestEntry] = {}
+        self._remote: Dict[str, ManifestEntry] = {}
+
+    def changed(self, name: str, path: pathlib.Path) -> bool:
+        """whether a local file needs to be uploaded"""
+        stat = path.stat()
+        with self._lock:
+            entry = self._local.get(name)
+        if entry is None or entry.size != stat.st_size:
+            return True
+        if entry.mtime == stat.st_mtime:
+            return False
+        if hash_file(path) != entry.digest:
+            return True
+        with self._lock:
+            entry.mtime = stat.st_mtime
+        return False
+
+    def record_copy(self, name: str, path: pathlib.Path):
+        """a local file that has the same content on the share (uploaded, or written to the share by a container)"""
+        stat = path.stat()
+        entry = ManifestEntry(size=stat.st_size, mtime=stat.st_mtime, digest=hash_file(path))
+        with self._lock:
+            self._local[name] = entry
+            self._remote[name] = ManifestEntry(size=stat.st_size)
+
+    def record_write(self, name: str, size: int):
+        """a file written to the share that has no local copy"""
+        with self._lock:
+            self._local.pop(name, None)
+            self._remote[name] = ManifestEntry(size=size)
+
+    def record_remote(self, name: str, size: int, mtime: float):
+        """state of an uploaded file after listing the share"""
+        with self._lock:
+            if (entry := self._remote.get(name)) is not None and entry.size == size:
+                entry.mtime = mtime
+
+    def is_new(self, name: str, size: int, mtime: float) -> bool:
+        """whether a file on the share was not uploaded in this run or was changed since"""
+        with self._lock:
+            entry = self._remote.get(name)
+        if entry is None or entry.size != size:
+            return True
+        return entry.mtime is not None and entry.mtime != mtime
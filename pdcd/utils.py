@@ -1,11 +1,17 @@
 import subprocess
+import concurrent.futures
+import functools
+import io
 import os
 import platform
 import socket
+import threading
+import time
 import uuid
 import pathlib
 from contextlib import closing
 from enum import Enum
+from typing import Iterator, Dict, Any, Callable
 
 
 def shell(cli: list, env: dict = None, timeout: int = 60, check: bool = True, **kwargs) -> bytes:
@@ -43,6 +49,47 @@ def find_free_local_port() -> int:
         return s.getsockname()[1]
 
 
+def wait_for_local_port(port: int, timeout: float = 30, interval: float = 0.1) -> bool:
+    """wait until something is listening on a local port; returns False on timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=interval):
+                return True
+        except OSError:
+            time.sleep(interval)
+    return False
+
+
+def single_flight(fn: Callable) -> Callable:
+    """
+    cache results like functools.lru_cache, but when another thread is already calling with the same arguments,
+    wait for its result instead of calling again; failures are not cached
+    """
+    lock = threading.Lock()
+    results: Dict[Any, concurrent.futures.Future] = {}
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            future = results.get(key)
+            owner = future is None
+            if owner:
+                future = results[key] = concurrent.futures.Future()
+
+        if owner:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                with lock:
+                    results.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+    return wrapper
+
+
 def generate_uuid() -> str:
     return str(uuid.uuid4())
 
@@ -83,3 +130,25 @@ class CaseInsensitiveEnum(Enum):
             if member.name.lower() == value.lower():
                 return member
         raise KeyError(f"{value} is not a valid enum member")
+
+
+class IterStream(io.RawIOBase):
+    # read-only file-like wrapper for an iterator of byte chunks (e.g. a streamed HTTP response)
+    #   so it can be consumed by readers such as tarfile without buffering the whole stream
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._pending) == 0:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
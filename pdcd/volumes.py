@@ -0,0 +1,99 @@
+import threading
+import uuid
+from typing import Optional, Set
+from docker.client import DockerClient as DockerSDKClient
+from docker.errors import ImageNotFound
+from docker.utils import parse_repository_tag
+
+from .log import logger
+
+SHARED_VOLUME_TYPES = ["volume", "tmpfs"]
+
+
+class SharedVolume:
+    # This class is a named Docker volume that is mounted as the shared directory of all containers of a run on
+    #   a Docker endpoint instead of bind mounting the file directory
+    # Artifacts that are only needed by other jobs are copied into the volume rather than out to the file
+    #   directory (and the remote share), so chained jobs do not go through the host filesystem
+    # A tmpfs volume is only mounted while a container uses it, so a keeper container holds it for the run
+    # The keeper runs the configured keeper image (pulled if missing) and falls back to the image of the first
+    #   routine when that image cannot be used, e.g. when the Docker host cannot reach the registry
+    def __init__(
+        self,
+        docker: DockerSDKClient,
+        tmpfs: bool = False,
+        size: Optional[str] = None,
+        keeper_image: Optional[str] = None,
+    ):
+        self._docker = docker
+        self.tmpfs = tmpfs
+        self.size = size
+        self.keeper_image = keeper_image
+        self.name = f"pdcd-{uuid.uuid4().hex[:12]}"
+        self._lock = threading.Lock()
+        self._created = False
+        self._keeper = None
+        # names of the files copied into the volume during the run
+        self.produced: Set[str] = set()
+
+    def ensure(self, image_id: str):
+        """create the volume (and for tmpfs the keeper container) before its first use"""
+        with self._lock:
+            if not self._created:
+                driver_opts = {}
+                if self.tmpfs:
+                    driver_opts = {"type": "tmpfs", "device": "tmpfs"}
+                    if self.size is not None:
+                        driver_opts["o"] = f"size={self.size}"
+                self._docker.volumes.create(name=self.name, driver="local", driver_opts=driver_opts)
+                self._created = True
+                logger.info(f"Created shared volume {self.name} ({'tmpfs' if self.tmpfs else 'disk'})")
+
+            if self.tmpfs and self._keeper is None:
+                images = [image for image in [self.keeper_image, image_id] if image is not None]
+                for image in images:
+                    try:
+                        self._keeper = self._start_keeper(image)
+                        break
+                    except Exception as e:
+                        logger.warning(f"Could not start keeper container for {self.name} from image {image}: {e}")
+                if self._keeper is None:
+                    raise Exception(f"Could not start keeper container for shared volume {self.name}")
+
+    def _start_keeper(self, image: str):
+        if image == self.keeper_image:
+            try:
+                self._docker.images.get(image)
+            except ImageNotFound:
+                repository, tag = parse_repository_tag(image)
+                logger.info(f"Pulling keeper image {image} for shared volume {self.name}")
+                self._docker.images.pull(repository, tag=tag)
+        keeper = self._docker.containers.create(
+            image=image,
+            entrypoint=["sleep", "infinity"],
+            command=[],
+            labels={"pdcd": "true", "pdcd.volume": self.name},
+            volumes={self.name: {"bind": "/shared", "mode": "rw"}},
+        )
+        try:
+            keeper.start()
+        except Exception as e:
+            keeper.remove(v=True, force=True)
+            raise e
+        return keeper
+
+    def remove(self):
+        with self._lock:
+            if self._keeper is not None:
+                try:
+                    self._keeper.remove(force=True)
+                except Exception as e:
+                    logger.error(f"Could not remove keeper container {self._keeper.short_id}: {e}")
+                self._keeper = None
+            if self._created:
+                try:
+                    self._docker.volumes.get(self.name).remove(force=True)
+                except Exception as e:
+                    # e.g. containers that were not cleaned up still use the volume
+                    logger.warning(f"Could not remove shared volume {self.name}: {e}")
+                self._created = False
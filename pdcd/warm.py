@@ -0,0 +1,74 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+from .log import logger
+
+
+class WarmContainer:
+    # a started container that routines run their CLI in via exec
+    def __init__(self, ctr, bind_dir: str):
+        self.ctr = ctr
+        self.bind_dir = bind_dir
+        self.uses = 0
+
+
+class WarmPool:
+    # This class keeps started containers per image on a Docker endpoint so that routines using the same image
+    #   can run their CLI with exec instead of creating, starting and removing a container each time
+    # Each container is used by a single routine at a time. Containers are removed after a number of uses, or
+    #   right away when a routine using them did not succeed or was stopped, so that anything left behind by
+    #   previous routines (besides the shared directory) does not build up
+    # When all containers of an image are in use or one cannot be started, routines fall back to their own container
+    def __init__(self, size: int, max_uses: int):
+        self.size = size
+        self.max_uses = max_uses
+        self._lock = threading.Lock()
+        # keyed by image ID (plus the container limits, see Routine.warm_key)
+        self._idle: Dict[str, List[WarmContainer]] = {}  # key -> idle containers
+        self._counts: Dict[str, int] = {}  # key -> number of containers (idle or in use)
+        self._closing = False
+
+    def acquire(self, image_id: str, create: Callable[[], WarmContainer]) -> Optional[WarmContainer]:
+        with self._lock:
+            if self._closing:
+                return None
+            idle = self._idle.setdefault(image_id, [])
+            if len(idle) > 0:
+                return idle.pop()
+            if self._counts.get(image_id, 0) >= self.size:
+                return None
+            self._counts[image_id] = self._counts.get(image_id, 0) + 1
+
+        try:
+            warm = create()
+        except Exception as e:
+            with self._lock:
+                self._counts[image_id] -= 1
+            raise e
+        logger.info(f"Started warm container {warm.ctr.short_id} for image {image_id[:19]}")
+        return warm
+
+    def release(self, image_id: str, warm: WarmContainer, reuse: bool):
+        warm.uses += 1
+        with self._lock:
+            if reuse and warm.uses < self.max_uses and not self._closing:
+                self._idle[image_id].append(warm)
+                return
+            self._counts[image_id] -= 1
+        self._remove(warm)
+
+    @staticmethod
+    def _remove(warm: WarmContainer):
+        try:
+            warm.ctr.remove(v=True, force=True)
+        except Exception as e:
+            logger.error(f"Could not remove warm container {warm.ctr.short_id}: {e}")
+
+    def close(self):
+        # containers that are in use are removed when they are released
+        with self._lock:
+            self._closing = True
+            idle = [warm for containers in self._idle.values() for warm in containers]
+            self._idle.clear()
+        for warm in idle:
+            self._remove(warm)